@@ -0,0 +1,219 @@
+# tests of the exporter on threeMayaMock scenes, they run without maya:
+# python -m unittest test_threeMaya
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import threeMaya
+import threeMayaMock
+
+
+def mixedScene():
+    # meshes with split uvs, colors and several materials, skinned to a short animated skeleton
+    scene = threeMayaMock.MockScene()
+    scene.addMesh('a', faces=3000, uvSplit=0.2, materials=3, colors=True)
+    scene.addMesh('b', faces=800, offset=(5,0,0))
+    scene.addMesh('c', faces=1200, materials=4, offset=(9,0,0))
+    scene.addSkeleton(bones=12, frames=5)
+    return scene
+
+
+def shapeRaw(scene, msh):
+    # raw buffers of a mock mesh, as extractGeometry gives them to buildGeometry
+    shp = scene.shapes[msh]
+    shaders = range( len(shp['materials']) )
+    raw = {
+        'name': str(msh),
+        'shaders': shaders,
+        'faceShaders': shp['faceShaders'] if len(shaders) > 1 else None,
+        'indexed': False,
+        }
+    raw.update( scene.buffers(shp['shape'], shp['colors']) )
+    return raw
+
+
+def listRaw(raw):
+    # the same buffers as plain lists, the way they are read face by face without numpy
+    return dict( (k, v.tolist() if isinstance(v, numpy.ndarray) else v) for k,v in raw.items() )
+
+
+def faceTriangles(db):
+    # triangles of the face stream as (material, corners), each corner a (position, normal, uv, color) tuple
+    # quads are fanned from their first corner, as indexFaces does
+    faces = numpy.asarray(db['faces']).tolist()
+    vertices = numpy.asarray(db['vertices']).reshape(-1, 3).tolist()
+    normals = numpy.asarray(db['normals']).reshape(-1, 3).tolist()
+    uvs = numpy.asarray(db['uvs'][0]).reshape(-1, 2).tolist()
+    colors = numpy.asarray(db['colors']).tolist()
+
+    triangles = []
+    i = 0
+    while i < len(faces):
+        kind = faces[i]
+        n = 4 if kind & threeMaya.FACE_QUAD else 3
+        vtx = faces[i+1:i+1+n]
+        i += 1 + n
+        material = None
+        if kind & threeMaya.FACE_MATERIAL:
+            material = faces[i]
+            i += 1
+        uv = [None]*n
+        if kind & threeMaya.FACE_VERTEX_UV:
+            uv = [ tuple(uvs[k]) for k in faces[i:i+n] ]
+            i += n
+        nrm = [None]*n
+        if kind & threeMaya.FACE_VERTEX_NORMAL:
+            nrm = [ tuple(normals[k]) for k in faces[i:i+n] ]
+            i += n
+        col = [None]*n
+        if kind & threeMaya.FACE_VERTEX_COLOR:
+            col = [ colors[k] for k in faces[i:i+n] ]
+            i += n
+
+        corners = [ (tuple(vertices[v]), nrm[k], uv[k], col[k]) for k,v in enumerate(vtx) ]
+        for k in xrange(n - 2):
+            triangles.append( (material, (corners[0], corners[k+1], corners[k+2])) )
+    return triangles
+
+
+def indexedTriangles(db):
+    # triangles of the indexed layout, the same way as faceTriangles
+    vertices = numpy.asarray(db['vertices']).reshape(-1, 3).tolist()
+    normals = numpy.asarray(db['normals']).reshape(-1, 3).tolist()
+    uvs = numpy.asarray(db['uvs'][0]).reshape(-1, 2).tolist()
+    colors = numpy.asarray(db['colors']).tolist()
+    indices = numpy.asarray(db['indices']).tolist()
+
+    corners = [ (tuple(vertices[v]), tuple(normals[v]), tuple(uvs[v]), colors[v]) for v in xrange(len(vertices)) ]
+    triangles = []
+    for group in db['groups']:
+        for i in xrange(group['start'], group['start'] + group['count'], 3):
+            triangles.append( (group['materialIndex'], tuple( corners[v] for v in indices[i:i+3] )) )
+    return triangles
+
+
+def writeText(e, **kwargs):
+    # text of the main json file written by the exporter
+    path = tempfile.mkdtemp()
+    try:
+        e.write('test', path, **kwargs)
+        f = open( os.path.join(path, 'test.js') )
+        try:
+            return f.read()
+        finally:
+            f.close()
+    finally:
+        shutil.rmtree(path)
+
+
+
+class RoundingTest(unittest.TestCase):
+
+    def test_roundArray(self):
+        # ties go away from zero, like round
+        values = numpy.concatenate( ( numpy.arange(-64, 65) / 32.0, numpy.arange(-2000, 2001) / 2000.0, [0.125, -0.125, 2.675, 1.005] ) )
+        for decimals in (2, 3, 4):
+            self.assertEqual( threeMaya.roundArray(values, decimals).tolist(), threeMaya.roundList(values.tolist(), decimals) )
+
+
+    def test_bulkListParity(self):
+        # points on a 1/32 grid, normals and uvs (of the 16x16 quads) on a 1/16 grid are all ties once rounded
+        scene = threeMayaMock.MockScene()
+        msh = scene.addMesh('grid', faces=256)
+        raw = shapeRaw(scene, msh)
+        raw['points'] = numpy.round( raw['points'] * 32 ) / 32.0 - 0.5
+        raw['normals'] = numpy.round( raw['normals'] * 16 ) / 16.0
+
+        geo = threeMaya.buildGeometry(raw)
+        ref = threeMaya.buildGeometryList( listRaw(raw) )
+        for key in ('vertices', 'normals', 'uvs'):
+            self.assertEqual( numpy.asarray(geo[key]).tolist(), ref[key], key )
+        self.assertEqual( numpy.asarray(geo['faces']).tolist(), ref['faces'] )
+
+
+    def test_bulkListParityAttributes(self):
+        # split uvs, colors and materials
+        scene = threeMayaMock.MockScene()
+        msh = scene.addMesh('a', faces=500, uvSplit=0.3, materials=3, colors=True)
+        raw = shapeRaw(scene, msh)
+
+        geo = threeMaya.buildGeometry(raw)
+        ref = threeMaya.buildGeometryList( listRaw(raw) )
+        for key in ('vertices', 'normals', 'uvs', 'colors', 'faces'):
+            self.assertEqual( numpy.asarray(geo[key]).tolist(), ref[key], key )
+
+
+
+class ExportTest(unittest.TestCase):
+
+    def test_workers(self):
+        # shapes built in worker processes give the same model
+        out = []
+        for workers in (1, 2):
+            e = threeMaya.Exporter(scene=mixedScene(), workers=workers)
+            e.exportSkeleton()
+            out.append( e.encode() )
+        self.assertEqual(out[0], out[1])
+
+
+    def test_cache(self):
+        # shapes read back from the cache give the same files as built ones
+        path = tempfile.mkdtemp()
+        try:
+            out = []
+            for cache in (None, path, path):
+                e = threeMaya.Exporter(scene=mixedScene(), cache=cache)
+                e.exportSkeleton()
+                out.append( [ writeText(e), writeText(e, compact=True) ] )
+            self.assertEqual(e.cache.misses, 0)
+            self.assertEqual(out[0], out[1])
+            self.assertEqual(out[0], out[2])
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_dump(self):
+        # the default output is the text of json.dumps
+        e = threeMaya.Exporter(scene=mixedScene())
+        e.exportSkeleton()
+        e.exportAnimation(0, 5)
+        self.assertEqual( writeText(e), threeMaya.json.dumps(e.db, default=threeMaya.jsonDefault) )
+
+
+    def test_ngons(self):
+        # hexagons are split in 4 triangles, quads and triangles are kept
+        scene = threeMayaMock.MockScene()
+        msh = scene.addMesh('n', faces=400, uvSplit=0.3, materials=3, colors=True, ngons=0.5)
+        counts = scene.shapes[msh]['raw']['counts']
+        hexagons = (counts == 6).sum()
+        self.assertTrue(hexagons)
+
+        e = threeMaya.Exporter(scene=scene)
+        self.assertEqual( e.db['metadata']['faces'], (counts <= 4).sum() + 4*hexagons )
+
+        e = threeMaya.Exporter(scene=scene, indexed=True)
+        self.assertEqual( len(e.db['indices']), 3 * (counts - 2).sum() )
+
+
+    def test_indexed(self):
+        # the indexed layout draws the triangles of the face stream
+        for kwargs in ( {'faces': 500, 'uvSplit': 0.3, 'materials': 3, 'colors': True}, {'faces': 300, 'colors': True, 'ngons': 0.5} ):
+            out = []
+            for indexed in (False, True):
+                scene = threeMayaMock.MockScene()
+                scene.addMesh('a', **kwargs)
+                out.append( threeMaya.Exporter(scene=scene, indexed=indexed).db )
+
+            faces = faceTriangles(out[0])
+            indexed = indexedTriangles(out[1])
+            self.assertEqual( len(faces), len(indexed) )
+            self.assertEqual( sorted(faces), sorted(indexed) )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
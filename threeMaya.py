@@ -1,4 +1,4 @@
-__version__ = '0.4'
+__version__ = '0.6'
 __author__ = 'Thomas Guittonneau'
 __email__ = 'wougzy@gmail.com'
 
@@ -8,19 +8,40 @@ __email__ = 'wougzy@gmail.com'
 
 # todo:
 # -basic UI
-# -secure skeleton/weights export (maxInf, 2 joints)
 # -secure file writing
-# -export blendshapes
-# -better texture handling (bake, 2d placement)
 # -export bump textures
 
 
 import sys
 import os.path
+import time
 import shutil
+import tempfile
 import json
-import maya.OpenMaya as om
-import pymel.core as pm
+import ctypes
+import hashlib
+import cPickle
+import contextlib
+import multiprocessing
+from array import array
+
+try:
+    import maya.OpenMaya as om
+    import maya.OpenMayaAnim as oma
+    import pymel.core as pm
+except ImportError:
+    # no maya: MayaScene is unusable but the exporter still runs on other scenes (see threeMayaMock)
+    om = oma = pm = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# windows spawns pool processes with sys.executable, which is maya's gui in an interactive session:
+# worker processes (see buildGeometries) run mayapy instead. set once at import, it applies to every pool
+if sys.platform == 'win32' and os.path.basename(sys.executable).lower() == 'maya.exe':
+    multiprocessing.set_executable( os.path.join(os.path.dirname(sys.executable), 'mayapy.exe') )
 
 
 FACE_QUAD          = 0b00000001
@@ -42,51 +63,134 @@ DECIMALS_ROT      = 5
 DECIMALS_TIME     = 3
 
 ORDERED_DICTS = (
-    ( 'metadata', 'scale', 'materials', 'vertices', 'normals', 'colors', 'uvs', 'faces',
-        'morphTargets', 'bones', 'skinIndices', 'skinWeights', 'animation' ),
+    ( 'metadata', 'scale', 'buffer', 'materials', 'vertices', 'normals', 'colors', 'uvs', 'faces', 'indices', 'groups',
+        'geometries', 'instances', 'morphTargets', 'bones', 'influencesPerVertex', 'skinIndices', 'skinWeights', 'animation', 'animations' ),
 
-    ( 'formatVersion', 'generatedBy', 'vertices', 'faces', 'normals', 'colors', 'uvs', 'materials', 'morphTargets', 'bones' ),
+    ( 'formatVersion', 'generatedBy', 'layout', 'vertices', 'faces', 'normals', 'normalEncoding', 'colors', 'uvs', 'materials', 'morphTargets', 'bones', 'lods',
+        'geometries', 'instances' ),
 
     ( 'name', 'id', 'DbgName', 'DbgColor', 'DbgIndex', 'shading', 'blending',
         'colorAmbient', 'colorDiffuse', 'colorSpecular', 'mapDiffuse',
         'specularCoef', 'transparency', 'transparent',
-        'depthTest', 'depthWrite', 'doubleSided', 'vertexColors' )
+        'depthTest', 'depthWrite', 'doubleSided', 'vertexColors' ),
+
+    ( 'type', 'offset', 'count', 'itemSize', 'scale' ),
+
+    ( 'start', 'count', 'materialIndex' ),
+
+    ( 'name', 'geometry', 'vertices', 'faces', 'matrix' ),
+
+    ( 'target', 'ratio', 'vertices', 'faces' )
 )
 
+ENCODE_INDENT = 2
+ENCODE_CHUNK  = 4096
 
-class Exporter(object):
+# what each entry of a shape face stream points to, so it can be shifted when shapes are merged
+INDEX_NONE   = 0
+INDEX_VERTEX = 1
+INDEX_UV     = 2
+INDEX_NORMAL = 3
+INDEX_COLOR  = 4
+INDEX_MATERIAL = 5
 
-    def __init__(self, *args):
+# indexed layout: size of the fifo post-transform vertex cache triangles are ordered for, see tipsify
+VERTEX_CACHE = 16
 
-        nodes = pm.ls(args, et='transform')
-        if not nodes:
-            nodes = pm.selected(et='transform')
+# levels of detail: relative miss of their face ratio target above which vertices may merge across seams
+# (see decimate), and a level is reported
+LOD_TOLERANCE = 0.1
 
-        _sl = pm.selected()
-        pm.select(nodes, hi=1)
-        nodes = pm.selected()
-        pm.select(_sl)
+# re-export cache: files of built shapes kept on disk, removed least recently used first above CACHE_SIZE bytes
+CACHE_SIZE = 2**30
+CACHE_EXT  = '.geo'
 
-        geo = []
-        for node in pm.ls(nodes, et='mesh'):
-            msh = node.getParent()
-            if not msh in geo:
-                geo.append(msh)
+# texture copy: files copied at once by write, and bytes read at a time when hashing them
+TEXTURE_WORKERS = 4
+TEXTURE_CHUNK   = 2**20
+
+# procedural textures: default size of the images they are baked into, and their file type
+BAKE_RESOLUTION = 512
+BAKE_EXT        = '.png'
+
+# octahedral normals (binary and compact output, see octNormals): two signed integers of OCT_BITS bits each
+OCT_BITS = 16
+
+# binary output: typed arrays start on multiples of BINARY_ALIGN bytes of the .bin file
+# integers get the first of these types holding all their values
+BINARY_ALIGN = 4
+BINARY_INTS = (
+    ( 'Uint8Array',  '<u1' ),
+    ( 'Int8Array',   '<i1' ),
+    ( 'Uint16Array', '<u2' ),
+    ( 'Int16Array',  '<i2' ),
+    ( 'Uint32Array', '<u4' ),
+    ( 'Int32Array',  '<i4' ),
+    )
+
+
+class Exporter(object):
+
+    def __init__(self, *args, **kwargs):
+
+        # scene: where nodes and buffers are read from, MayaScene by default (see threeMayaMock for a stand-in)
+        # bulk: read mesh buffers at once through numpy when available
+        # workers: number of processes building the shapes, 0 for one per cpu
+        # profile: run every stage under cProfile, see self.report
+        # cache: folder where built shapes are kept between exports, see GeometryCache. cacheSize: its size in bytes
+        # lods: face ratios of the levels of detail built along the full geometry, (0.5, 0.25, 0.1) for instance, see decimate
+        # indexed: write triangles into a single index buffer over per vertex attributes instead of the face stream, see indexFaces
+        # instances: export identical shapes once in object space, with the world matrix of each mesh, see findInstances
+        self.bulk = kwargs.get('bulk', True) and numpy is not None
+        self.workers = kwargs.get('workers', 1)
+        self.report = Report( kwargs.get('profile', False) )
+
+        self.indexed = kwargs.get('indexed', False)
+        if self.indexed and numpy is None:
+            raise RuntimeError('indexed layout needs numpy')
+
+        # each level gets its own db of geometry buffers, written next to the main file
+        self.lods = []
+        for ratio in kwargs.get('lods', ()):
+            if numpy is None:
+                raise RuntimeError('levels of detail need numpy')
+            self.lods.append( {
+                'ratio': ratio,
+                'db': { 'metadata': { 'vertices': 0, 'faces': 0, 'normals': 0, 'colors': int(not self.indexed), 'uvs': 0 } },
+                'buffers': geometryBuffers(self.indexed),
+                'vertexIds': [],
+                'vertices': [],
+                'faces': [],
+                } )
+
+        self.cache = None
+        if kwargs.get('cache'):
+            self.cache = GeometryCache( kwargs['cache'], kwargs.get('cacheSize', CACHE_SIZE) )
+
+        self.scene = kwargs.get('scene')
+        if self.scene is None:
+            self.scene = MayaScene(self.bulk)
+        self.scene.reset()
 
         self.meshes = []
         self.shapes = []
 
-        for node in geo:
-            for shp in node.getShapes():
-                if isinstance(shp, pm.nt.Mesh) and shp.io.get()==0 and shp.isVisible():
-                    self.meshes.append(node)
-                    self.shapes.append(shp)
+        for msh,shp in self.scene.meshes(*args):
+            self.meshes.append(msh)
+            self.shapes.append(shp)
 
         if not self.meshes:
             raise RuntimeError('no mesh provided')
         else:
             print '# Exporting MESHES: %s'%str(self.meshes)
 
+        # shapes read in object space, and their fingerprint when it was already read
+        self.local = {}
+        self.instances = []
+        self._prints = {}
+        if kwargs.get('instances'):
+            self.findInstances()
+
 
 
         # db init
@@ -102,478 +206,1531 @@ class Exporter(object):
         self.materials = []
         self.textures = []
         self.db['materials'] = []
+        self._records = {}
+        self._keys = {}
 
         self.vertices = []
+        self.vertexIds = []
         self.faces = []
-        self.db['vertices'] = []
-        self.db['faces'] = []
-        self.db['uvs'] = [[]]
-        self.db['normals'] = []
-        self.db['colors'] = [16777215] #white for colorless
-
         self.db['metadata']['vertices'] = 0
         self.db['metadata']['faces'] = 0
+        self.db['metadata']['normals'] = 0
+        self.db['metadata']['colors'] = 1
+        self.db['metadata']['uvs'] = 0
+
+        if self.indexed:
+            self.db['metadata']['layout'] = 'indexed'
+            self.db['metadata']['colors'] = 0
+            self._acmr = [0, 0.0, 0.0]
+
+        # per shape buffers, lists or numpy arrays joined once all meshes are exported
+        self._buffers = geometryBuffers(self.indexed)
 
         self._prg_msh = len(self.shapes)
         self._prg_count = 0
-        pm.progressWindow( endProgress=True )
-        pm.progressWindow( title="Exporting meshes", progress=0, status="", maxValue=self._prg_msh )
+        self.scene.progressStart( "Exporting meshes", self._prg_msh )
 
         try:
-            for msh,shp in zip(self.meshes, self.shapes):
-                self.exportGeometry(msh,shp)
+            with self.report.stage('geometry') as _r:
+                _r['count'] = self._prg_msh
+
+                if self.workers == 1 or len(self.shapes) < 2:
+                    for msh,shp in zip(self.meshes, self.shapes):
+                        self.exportGeometry(msh,shp)
+
+                else:
+                    # read every shape from the scene first, then build them in parallel and merge them back in order
+                    geos = []
+                    raws = []
+                    for msh,shp in zip(self.meshes, self.shapes):
+                        geos.append( self.loadGeometry(msh, shp) )
+                        if geos[-1] is None:
+                            with self.report.stage('extract', str(msh)) as r:
+                                raws.append( self.extractGeometry(msh,shp) )
+                                r['count'] = len(raws[-1]['counts'])
+
+                    self.scene.progress( 'building %s meshes...'%len(raws) )
+                    built = iter( buildGeometries(raws, self.workers) )
+                    raws = iter(raws)
+                    for geo in geos:
+                        if geo is None:
+                            geo = built.next()
+                            self.report.add( geo.pop('report') )
+                            self.storeGeometry( raws.next(), geo )
+                        with self.report.stage('merge', geo['name']) as r:
+                            self.mergeGeometry(geo)
+                            r['count'] = geo['faceCount']
+
+                if self.cache is not None:
+                    _r['cacheHits'], _r['cacheMisses'] = self.cache.hits, self.cache.misses
+                    print '# Cache: %d hits, %d misses' % (self.cache.hits, self.cache.misses)
+                    self.cache.evict()
+
+                if self.indexed and self._acmr[0]:
+                    count, before, after = self._acmr
+                    _r['acmrBefore'], _r['acmrAfter'] = before/count, after/count
+                    print '# Vertex cache: ACMR %.3f -> %.3f over %d triangles' % (before/count, after/count, count)
         except:
-            pm.progressWindow( endProgress=True )
+            self.scene.progressEnd()
             from traceback import print_tb
             print sys.exc_info()[0]
             print_tb(sys.exc_info()[2])
             return None
 
-        pm.progressWindow( endProgress=True )
+        self.scene.progressEnd()
+
+        finishBuffers( self.db, self._buffers )
+        del self._buffers
 
+        for level in self.lods:
+            finishBuffers( level['db'], level.pop('buffers') )
+
+        # face ratio each level reached, levels that keep as many faces as the one above them are dropped
+        faces = self.db['metadata']['faces']
+        lods = []
+        for level in self.lods:
+            count = level['db']['metadata']['faces']
+            if count >= faces:
+                print '# Warning: level of detail %g dropped, it does not reduce the mesh (%d faces)' % (level['ratio'], count)
+                continue
+            level['reached'] = count / float(self.db['metadata']['faces'])
+            if abs(level['reached'] - level['ratio']) > LOD_TOLERANCE * level['ratio']:
+                print '# Warning: level of detail %g reached a face ratio of %.3f' % (level['ratio'], level['reached'])
+            lods.append(level)
+            faces = count
+        self.lods = lods
 
         self.db['metadata']['materials'] = len( self.db['materials'] )
-        self.db['metadata']['uvs'] = len(self.db['uvs'][0])/2
-        self.db['metadata']['normals'] = len(self.db['normals'])/3
 
+        if self.instances:
+            self.db['geometries'] = geometryRanges( self.meshes, self.vertices, self.faces )
+            self.db['instances'] = self.instances
+            self.db['metadata']['geometries'] = len(self.meshes)
+            self.db['metadata']['instances'] = len(self.instances)
+            for level in self.lods:
+                level['db']['geometries'] = geometryRanges( self.meshes, level['vertices'], level['faces'] )
 
+        if self.lods:
+            self.db['metadata']['lods'] = [ {
+                'target': level['ratio'],
+                'ratio': round(level['reached'], 3),
+                'vertices': level['db']['metadata']['vertices'],
+                'faces': level['db']['metadata']['faces'],
+                } for level in self.lods ]
+
+
+
+
+
+    def findInstances(self):
+        # group the meshes whose shapes have the same geometry in object space, maya instances and duplicates alike
+        # self.meshes and self.shapes only keep the first mesh of each group, its shape is read in object space,
+        # and self.instances gets the geometry (index in self.shapes) and world matrix of every mesh
+        # deformed shapes (skinCluster, blendShape) are never grouped and stay in world space, with an identity matrix
+        # shapes are told apart by their fingerprint, so nothing is grouped when it can't be read in bulk
+
+        meshes, shapes = self.meshes, self.shapes
+        self.meshes = []
+        self.shapes = []
+        groups = {}
+
+        with self.report.stage('instances') as r:
+            for msh, shp in zip(meshes, shapes):
+                matrix = [ [1.0,0,0,0], [0,1.0,0,0], [0,0,1.0,0], [0,0,0,1.0] ]
+                key = None
+                local = not self.scene.deformed(shp)
+                if local:
+                    matrix = self.scene.worldMatrix(msh)
+                    key = self.scene.fingerprint(shp, True)
+
+                k = groups.get(key)
+                if k is None:
+                    k = len(self.shapes)
+                    self.meshes.append(msh)
+                    self.shapes.append(shp)
+                    self.local[str(msh)] = local
+                    if key is not None:
+                        groups[key] = k
+                        self._prints[str(msh)] = key
+                elif str(shp) != str(self.shapes[k]):
+                    self.scene.release(shp)
+
+                self.instances.append( {
+                    'name': str(msh),
+                    'geometry': k,
+                    'matrix': roundList( [ x for row in matrix for x in row ], DECIMALS_ROT ),
+                    } )
+
+            r['count'] = len(self.shapes)
+
+        print '# Instances: %d meshes, %d geometries' % ( len(self.instances), len(self.shapes) )
 
 
 
     def exportGeometry(self, msh, shp):
 
-        # api calls
-        dag = shp.__apiobject__()
-        mshfn = om.MFnMesh(dag)
+        geo = self.loadGeometry(msh, shp)
+
+        if geo is None:
+            with self.report.stage('extract', str(msh)) as r:
+                raw = self.extractGeometry(msh, shp)
+                r['count'] = len(raw['counts'])
+
+            with self.report.stage('build', str(msh)) as r:
+                geo = buildShape(raw)
+                r['count'] = geo['faceCount']
+
+            self.storeGeometry(raw, geo)
+
+        with self.report.stage('merge', str(msh)) as r:
+            self.mergeGeometry(geo)
+            r['count'] = geo['faceCount']
+
+
+
+    def loadGeometry(self, msh, shp):
+        # built shape from the cache with its materials registered, None if it isn't there
+
+        if self.cache is None:
+            return None
+
+        key = self._prints.get(str(msh))
+        if key is None:
+            key = self.scene.fingerprint( shp, self.local.get(str(msh), False) )
+        if key is None:
+            return None
+        key = cacheKey( '%s %s %s' % ( key, [ level['ratio'] for level in self.lods ], self.indexed ) )
+        self._keys[str(msh)] = key
+
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        self.scene.release(shp)
+
+        with self.report.stage('load', str(msh)) as r:
+            geo = entry['geo']
+            geo['name'] = str(msh)
+            geo['materials'] = self.addMaterials( entry['slots'], entry['infos'] )
+            r['count'] = geo['faceCount']
+
+        self._prg_count += 1
+        self.scene.progress( step=1 )
+        return geo
+
+
+
+    def storeGeometry(self, raw, geo):
+        # keep a built shape in the cache, with the material records of its slots
+        # shapes with textures left to bake are skipped as their records hold scene nodes
+
+        geo['materials'] = raw['materials']
+
+        key = self._keys.get( raw['name'] )
+        if key is None:
+            return
+
+        slots = [ (name,) + self._records[name] for name in raw['slots'] ]
+        if any( 'bake' in t for name, m, textures in slots for t in textures ):
+            return
+
+        entry = { 'geo': dict(geo), 'slots': slots, 'infos': raw['infos'] }
+        del entry['geo']['materials']
+        self.cache.put(key, entry)
+
+
+
+    def extractGeometry(self, msh, shp):
+        # read materials and raw mesh buffers from the scene, raw buffers are described above bulkBuffers
+        # the shape is built with local material slots, raw['materials'] gives the db material of each slot
 
         # export materials
-        pm.progressWindow( edit=True, status='mesh %s/%s (%s): writing materials...'%(self._prg_count,self._prg_msh,msh) )
-
-        sgs = []
-        sgf = []
-
-        def faces(x):
-          f = []
-          for fs in x:
-            if fs.startswith('f'):
-              fs = fs.split('[')[1].split(']')[0]
-              if ':' in fs:
-                a, b = fs.split(':')
-                a, b = int(a), int(b)
-                f.extend(range(a, b + 1))
-              else:
-                f.append(int(fs))
-          return f
-
-        _o = shp.instObjGroups[0].objectGroups.outputs(type='shadingEngine')
-        if _o:
-            # multi mat
-            for _id in shp.instObjGroups[0].objectGroups.getArrayIndices():
-                og = shp.instObjGroups[0].objectGroups[_id]
-                f = faces( og.objectGrpCompList.get() )
-
-                _sg = og.outputs()
-                if _sg and f:
-                    sgs.append(_sg[0])
-                    sgf.append(f)
+        self.scene.progress( 'mesh %s/%s (%s): writing materials...'%(self._prg_count,self._prg_msh,msh) )
 
-        else:
-            # single mat
-            _o = shp.instObjGroups[0].outputs(type='shadingEngine')
-            sgs += _o
+        mats, faceShaders = self.scene.shading(shp)
+        infos = self.scene.shapeInfo(shp)
+
+        slots = []
+        for mat in mats:
+            if str(mat) not in self._records:
+                self._records[str(mat)] = self.scene.material(mat)
+            slots.append( (str(mat),) + self._records[str(mat)] )
+
+        sgi = self.addMaterials(slots, infos)
+
+        raw = {
+            'name': str(msh),
+            'shaders': range(len(sgi)),
+            'materials': sgi,
+            'slots': [ str(mat) for mat in mats ],
+            'infos': infos,
+            'lods': [ level['ratio'] for level in self.lods ],
+            'indexed': self.indexed,
+            'faceShaders': None,
+            }
+
+        # material of each face as an index in shaders
+        if len(sgi) > 1:
+            raw['faceShaders'] = faceShaders
+
+
+        # export buffers
+        self.scene.progress( 'mesh %s/%s (%s): reading buffers...'%(self._prg_count,self._prg_msh,msh) )
+
+        raw.update( self.scene.buffers( shp, infos['displayColors'], self.local.get(str(msh), False) ) )
+
+        self._prg_count += 1
+        self.scene.progress( step=1 )
+
+        return raw
 
-        doColors = shp.displayColors.get()
 
 
+    def addMaterials(self, slots, infos):
+        # register the (name, record, textures) materials of a shape in the db, returns their index in db materials
+
+        doColors = infos['displayColors']
+
         sgi = []
 
-        for sg in sgs:
-            mat = sg.surfaceShader.inputs()[0]
-            if str(mat) in self.materials:
+        for name, _m, textures in slots:
+            if name in self.materials:
                 if doColors:
                     for m in self.db['materials']:
-                        if m['name'] == str(mat):
+                        if m['name'] == name:
                             m['vertexColors'] = True
                             break
             else:
                 i = len(self.materials)
-                self.materials.append(str(mat))
+                self.materials.append(name)
 
                 m = {
                     'id' : i,
-                    'name' : str(mat),
+                    'name' : name,
 
                     'DbgColor' : 0xFFFFFF,
                     'DbgIndex' : i,
-                    'DbgName'  : str(mat),
+                    'DbgName'  : name,
                 }
 
+                # the record is copied in a fixed key order: json.dumps writes keys in dict order,
+                # which differs for the same keys inserted in another order (records read from the cache)
+                for key in sorted(_m):
+                    m[key] = _m[key]
+                for t in textures:
+                    t = dict(t)
+                    t['id'] = i
+                    self.textures.append(t)
+
                 self.db['materials'].append(m)
 
 
-                _nt = pm.nodeType(mat)
-                if _nt in ('lambert', 'phong', 'blinn', 'anisotropic'):
-                    m['shading'] = 'Phong'
-                    m['colorDiffuse'] = roundList( mat.color.get(), DECIMALS_COLOR )
-                    _c = pm.dt.Vector(mat.ambientColor.get()) + mat.incandescence.get()
-                    m['colorAmbient'] = roundList( _c, DECIMALS_COLOR )
-                    #m['colorEmissive'] = mat.incandescence.get()
-                    m['colorSpecular'] = [0,0,0]
+                if infos['doubleSided']:
+                    m['doubleSided'] = True
+                elif infos['opposite']:
+                    m['flipSided'] = True
 
-                    self.setTextureInfo(i, 'mapDiffuse', mat.color )
-                    self.setTextureInfo(i, 'mapLight', mat.ambientColor )
-                    self.setTextureInfo(i, 'mapBump', mat.normalCamera )
+                if doColors:
+                    m['vertexColors'] = True
 
-                    _t = mat.transparency.get()
-                    _t = 1 - (_t[0]+_t[1]+_t[2]) / 3
-                    if _t < 1:
-                        m['transparency'] = _t
-                        m['transparent'] = True
+            sgi.append( self.materials.index(name) )
 
-                if _nt in ('phong', 'blinn', 'anisotropic'):
-                    m['colorSpecular'] = roundList( mat.specularColor.get(), DECIMALS_COLOR )
-                    m['specularCoef'] = 10
-                    if _nt == 'blinn':
-                        m['specularCoef'] = 4 / mat.eccentricity.get()
-                    elif _nt == 'phong':
-                        m['specularCoef'] = mat.cosinePower.get() * 2
-                    if _nt == 'anisotropic':
-                        m['specularCoef'] = 4 / mat.roughness.get()
+        return sgi
 
 
-                    self.setTextureInfo(i, 'mapSpecular', mat.specularColor )
 
-                if _nt == 'surfaceShader':
-                    m['shading'] = 'Basic'
-                    m['colorDiffuse'] = roundList( mat.outColor.get(), DECIMALS_COLOR )
+    def mergeGeometry(self, geo):
+        # append the buffers of a built shape to the db, shifting its indices after the previous shapes
+        # its levels of detail go to the db of each level
 
+        _v = appendGeometry( geo, geo['materials'], self.db['metadata'], self._buffers )
+        self.vertices.append(_v)
+        self.faces.append(geo['faceCount'])
 
-                if shp.doubleSided.get():
-                    m['doubleSided'] = True
-                elif shp.opposite.get():
-                    m['flipSided'] = True
+        # indexed shapes split their vertices, per vertex data read later follows vertexIds
+        if 'vertexIds' in geo:
+            self.vertexIds.append( geo['vertexIds'] )
+            before, after = geo['acmr']
+            self._acmr[0] += geo['faceCount']
+            self._acmr[1] += before * geo['faceCount']
+            self._acmr[2] += after * geo['faceCount']
+            print '# %s: ACMR %.3f -> %.3f' % (geo['name'], before, after)
 
-                if doColors:
-                    m['vertexColors'] = True
+        for level, lod in zip(self.lods, geo.get('lods', [])):
+            level['vertices'].append( appendGeometry( lod, geo['materials'], level['db']['metadata'], level['buffers'] ) )
+            level['faces'].append( lod['faceCount'] )
+            level['vertexIds'].append( lod['vertexIds'] )
 
-            sgi.append( self.materials.index(str(mat)) )
 
 
 
-        # export vertices
-        _v = mshfn.numVertices()
-        _voffset = self.db['metadata']['vertices']
-        self.db['metadata']['vertices'] += _v
-        self.vertices.append(_v)
 
-        pm.progressWindow( edit=True, status='mesh %s/%s (%s): writing vertices...'%(self._prg_count,self._prg_msh,msh) )
+    def exportSkeleton(self, influences=2):
+        # influences: joints kept per vertex (1 to 4), the heaviest ones, their weights normalized
 
+        if not 1 <= influences <= 4:
+            raise ValueError('influences per vertex must be between 1 and 4, not %s' % influences)
 
-        _pts = om.MPointArray()
-        mshfn.getPoints(_pts, om.MSpace.kWorld)
+        with self.report.stage('skeleton') as _r:
+            # export skeleton
+            skins = [ self.scene.skin(shp) for shp in self.shapes ]
 
-        for i in xrange(_v):
-            _p = [ _pts[i][0], _pts[i][1], _pts[i][2] ]
-            self.db['vertices'] += roundList( _p, DECIMALS_VERTICES )
+            if any(skins):
+                _indices = []
+                _weights = []
 
 
-        # export faces
-        _f = mshfn.numPolygons()
-        self.db['metadata']['faces'] += _f
-        self.faces.append(_f)
+                # export bones
+                self.infs = []
+                self._samples = {}
+                _ids = {}
 
-        pm.progressWindow( edit=True, status='mesh %s/%s (%s): writing faces...'%(self._prg_count,self._prg_msh,msh) )
+                if self.cache is not None:
+                    _hits, _misses = self.cache.hits, self.cache.misses
 
+                _levels = [ ([], []) for level in self.lods ]
 
-        uvs = {}
+                for k, (msh, skin) in enumerate( zip(self.meshes, skins) ):
 
-        _noffset = len(self.db['normals'])/3
-        _normals = om.MFloatVectorArray()
-        mshfn.getNormals(_normals,om.MSpace.kWorld)
-        for i in xrange(_normals.length()):
-            _n = [ _normals[i][0], _normals[i][1], _normals[i][2] ]
-            self.db['normals'] += roundList( _n, DECIMALS_NORMALS )
-        _npf = om.MIntArray()
-        _nid = om.MIntArray()
-        mshfn.getNormalIds(_npf, _nid)
+                    if skin:
+                        infs, weights = skin
+                        for inf in infs:
+                            if not inf in _ids:
+                                _ids[inf] = len(self.infs)
+                                self.infs.append(inf)
 
-        _coffset = len(self.db['colors'])
 
+                        # export weights
+                        # reduce the skinCluster to the heaviest influences of each vertex, see topWeights
+                        infid = [ _ids[x] for x in infs ]
 
-        _vfoffset = 0
+                        if numpy is not None:
+                            # column -1 (missing influence) picks the last id, -1 too
+                            cols, w = self.reduceWeights(msh, infs, weights, influences)
+                            cols = numpy.asarray(infid + [-1], numpy.int64)[cols]
+                            w = roundArray(w, DECIMALS_WEIGHTS)
 
-        it = om.MItMeshPolygon(dag)
-        while not it.isDone():
-            f = it.index()
+                            # levels of detail keep the weights of the vertices they kept
+                            for level, (_i, _w) in zip(self.lods, _levels):
+                                _i.append( cols[ level['vertexIds'][k] ].ravel() )
+                                _w.append( w[ level['vertexIds'][k] ].ravel() )
 
-            # vertices
-            _vtx = om.MIntArray()
-            it.getVertices( _vtx )
-            vtx = [x+_voffset for x in _vtx]
+                            # split vertices of indexed shapes take the weights of their scene vertex
+                            if self.vertexIds:
+                                cols, w = cols[ self.vertexIds[k] ], w[ self.vertexIds[k] ]
+                            _indices.append( cols.ravel() )
+                            _weights.append( w.ravel() )
 
-            if len(vtx)>4:
-                self.db['metadata']['faces'] -= 1
-                self.faces[-1] -= 1
-                it.next()
-                _vfoffset += len(vtx)
-                continue
-            else:
-                dbf = [0]
-                dbf += vtx
-                if len(vtx)==4:
-                    dbf[0] += FACE_QUAD
+                        else:
+                            for w in weights:
+                                w = sorted( zip(infid, w), key=lambda vweight: vweight[1] )[-influences:][::-1]
+                                n = sum( x[1] for x in w ) or 1.0
+                                if len(w) == 1:
+                                    w = [ (w[0][0], n) ]
+                                w += [ (-1, 0) ] * (influences - len(w))
 
-            # material
-            dbf[0] += FACE_MATERIAL
+                                _indices += [ x[0] for x in w ]
+                                _weights += [ round( x[1]/n, DECIMALS_WEIGHTS ) for x in w ]
 
-            if len(sgs)==1:
-                dbf.append(sgi[0])
-            else:
-                for i,fset in enumerate(sgf):
-                    if f in fset:
-                        dbf.append(sgi[i])
-                        break
 
-            # uvs
-            _u = om.MFloatArray()
-            _v = om.MFloatArray()
-            try:
-                it.getUVs( _u, _v )
-                dbf[0] += FACE_VERTEX_UV
+                    else:
+                        pass
+                        #mais pas oublier de faire les mesh non anime aussi
+
+
+                if self.cache is not None:
+                    _r['cacheHits'] = self.cache.hits - _hits
+                    _r['cacheMisses'] = self.cache.misses - _misses
+                    print '# Cache: %d hits, %d misses' % (_r['cacheHits'], _r['cacheMisses'])
+                    self.cache.evict()
+
+                for level, (_i, _w) in zip(self.lods, _levels):
+                    level['db']['influencesPerVertex'] = influences
+                    level['db']['skinIndices'] = joinBuffers(_i)
+                    level['db']['skinWeights'] = joinBuffers(_w)
+
+                self.db['influencesPerVertex'] = influences
+                self.db['skinIndices'] = joinBuffers(_indices) if numpy is not None else _indices
+                self.db['skinWeights'] = joinBuffers(_weights) if numpy is not None else _weights
 
-                for v,uv in zip( vtx, zip(_u,_v) ):
-                    uv = roundList(uv, DECIMALS_UVS)
 
-                    if not uvs.get(v):
-                        uvs[v] = []
+                self.bones  = []
 
-                    exported = False
-                    for _i,_uv in uvs[v]:
-                        if _uv == uv:
-                            dbf.append(_i)
-                            exported = True
+                _world = [ self.scene.worldMatrix(inf) for inf in self.infs ]
+
+                for i,inf in enumerate(self.infs):
+                    b = {}
+                    b['name'] = str(inf).split('|')[-1].split(':')[-1]
+
+                    b['parent'] = -1
+                    for p in self.scene.parents(inf):
+                        if p in self.infs:
+                            b['parent'] = self.infs.index(p)
                             break
 
-                    if not exported:
-                        i = len(self.db['uvs'][0])/2
-                        self.db['uvs'][0] += uv
-                        uvs[v].append((i,uv))
-                        dbf.append(i)
-            except:
-                pass
-                #print '# warning: %s.f[%s] has no uv' % (shp, f)
-
-            # normals
-            dbf[0] += FACE_VERTEX_NORMAL
-
-            for i in xrange( len(vtx) ):
-                _n = _nid[i+_vfoffset]
-                dbf.append(_n+_noffset)
-
-            # colors
-            if doColors:
-                dbf[0] += FACE_VERTEX_COLOR
-
-                for i in xrange( len(vtx) ):
-                    if it.hasColor( i ):
-                        color = om.MColor()
-                        it.getColor( color, i )
-                        c = (int(color[0]*255)<<16) + (int(color[1]*255)<<8) + int(color[2]*255)
-                        self.db['colors'].append(c)
-                        dbf.append(i+_vfoffset+_coffset)
-                    else:
-                        # white for colorless vertex
-                        dbf.append(0)
-                        _coffset -= 1
+                    _m = _world[i]
+                    if b['parent'] != -1:
+                        _m = matrixMult( _m, matrixInverse(_world[b['parent']]) )
 
+                    _pos, _rot = decomposeMatrix(_m)
+                    b['pos'] = roundList( _pos, DECIMALS_POS )
+                    b['rotq'] = roundList( _rot, DECIMALS_ROT )
 
-            _vfoffset += len(vtx)
+                    self.bones.append(b)
 
-            # add face
-            self.db['faces'] += dbf
-            it.next()
 
+                self.db['metadata']['bones'] = len(self.bones)
+                self.db['bones'] = self.bones
+                _r['count'] = len(self.bones)
 
-        self._prg_count += 1
-        pm.progressWindow( edit=True, step=1 )
 
 
 
 
-    def exportSkeleton(self):
+    def reduceWeights(self, msh, infs, weights, influences):
+        # topWeights of a skin, from the cache when the shape, its influences and their weights are unchanged
 
-        # export skeleton
-        deformed = False
+        key = self._keys.get( str(msh) )
+        if key is None:
+            return topWeights(weights, influences)
 
-        for msh in self.shapes:
-            skin = msh.listHistory( type='skinCluster' )
-            if skin:
-                deformed = True
-                break
+        if not isArray(weights):
+            weights = numpy.asarray( list(weights), numpy.float64 )
+        key = cacheKey( digest( [ key, influences, map(str, infs), weights ] ) )
 
-        if deformed:
-            self.db['skinIndices'] = []
-            self.db['skinWeights'] = []
+        top = self.cache.get(key)
+        if top is None:
+            top = topWeights(weights, influences)
+            self.cache.put(key, top)
+        return top
 
 
-            # export bones
-            self.infs = []
 
-            for msh in self.shapes:
+    def exportAnimation(self, _start, _end):
+
+        with self.report.stage('animation') as _r:
+            # export simple anim
+            _keys = self.scene.keyTimes(self.infs)
+
+            if _keys:
+                self.db['animation'] = self.buildAnimation('anim0', _start, _end)
+                _r['count'] = len(self.infs) * int(_end - _start)
+
+
+
+    def exportAnimations(self, clips=None):
+        # one animation per (name, start, end) clip in db['animations'], end excluded as in exportAnimation
+        # clips are read from the scene (time editor clips, time slider bookmarks) when not given
+        # frames shared by several clips, or already exported, are only sampled once
+
+        with self.report.stage('animation') as _r:
+            if clips is None:
+                clips = self.scene.clips()
+
+            _keys = self.scene.keyTimes(self.infs)
+
+            if _keys and clips:
+                print '# Exporting CLIPS: %s' % ', '.join( str(c[0]) for c in clips )
+                self.db['animations'] = [ self.buildAnimation(name, _start, _end) for name, _start, _end in clips ]
+                _r['count'] = sum( len(self.infs) * int(_end - _start) for name, _start, _end in clips )
+
+
+
+    def buildAnimation(self, name, _start, _end):
+        # three.js animation of the bones from frame _start to _end (excluded)
+
+        anim = {}
+        anim['name'] = name
+
+        fps = self.scene.fps()
+        anim['fps'] = fps
+        anim['length'] = round( (_end-_start)/float(anim['fps']), DECIMALS_TIME )
+
+        frames = int(_end - _start)
+        _samples = self.sampleFrames( [ frame+_start for frame in xrange(frames) ] )
+        _times = [ round( frame/float(fps), DECIMALS_TIME ) for frame in xrange(frames) ]
+
+        anim['hierarchy'] = []
+
+        for i,inf in enumerate(self.infs):
+            _inf = {}
+            _inf['parent'] = self.bones[i]['parent']
+            _inf['keys'] = []
+
+            for frame in xrange(frames):
+                _pos, _rot = _samples[frame]
+
+                _key = {}
+                _key['time'] = _times[frame]
+                _key['pos'] = _pos[i]
+                _key['rot'] = _rot[i]
+                if frame==0:
+                    _key['scl'] = [1,1,1]
+
+                _inf['keys'].append(_key)
+
+            _inf['keys'].append( {'time': anim['length']} )
+
+            anim['hierarchy'].append(_inf)
+
+        return anim
+
+
+
+    def sampleFrames(self, times):
+        # rounded local pos and rot of every bone at each frame of times
+        # every frame is evaluated once for all bones, then kept in self._samples for the next clips
+
+        missing = sorted( set(times).difference(self._samples) )
+        if missing:
+            _world = self.scene.worldMatrices( self.infs, missing )
+            _pos, _rot = localTransforms( _world, [ b['parent'] for b in self.bones ] )
+            if numpy is not None:
+                _pos = roundArray( _pos, DECIMALS_POS ).tolist()
+                _rot = roundArray( _rot, DECIMALS_ROT ).tolist()
+            else:
+                _pos = [ [ roundList(p, DECIMALS_POS) for p in f ] for f in _pos ]
+                _rot = [ [ roundList(q, DECIMALS_ROT) for q in f ] for f in _rot ]
+
+            for t, p, q in zip(missing, _pos, _rot):
+                self._samples[t] = (p, q)
+
+        return [ self._samples[t] for t in times ]
+
+
+
+    def exportMorphTargets(self, threshold=10**-DECIMALS_VERTICES, dense=False):
+        # blendShape targets of the meshes in db['morphTargets'], targets of the same name on several meshes are merged
+        # only the vertices moved by more than threshold are kept, as 'indices' in the vertices and their 'deltas'
+        # dense: full 'vertices' positions of each target instead, for loaders that only read those
+        # targets are read from the scene one at a time, memory only grows with the deltas kept
+
+        if numpy is None:
+            raise RuntimeError('morph targets need numpy')
+
+        with self.report.stage('morph') as _r:
+            targets = []
+            _ids = {}
+            _offset = 0
+            _count = 0
+
+            for k, (shp, nv) in enumerate( zip(self.shapes, self.vertices) ):
+                for name, indices, deltas in self.scene.morphTargets(shp):
+                    deltas = roundArray( numpy.asarray(deltas, numpy.float64).reshape(-1, 3), DECIMALS_VERTICES )
+                    moved = numpy.sqrt( (deltas*deltas).sum(1) ) > threshold
+                    indices = numpy.asarray(indices, numpy.int64)[moved]
+                    deltas = deltas[moved]
+                    _count += 1
+
+                    # indexed shapes move every vertex split from a scene vertex
+                    if self.vertexIds:
+                        indices, picked = splitIndices( self.vertexIds[k], indices )
+                        deltas = deltas[picked]
+
+                    if name not in _ids:
+                        _ids[name] = len(targets)
+                        targets.append( { 'name': name, 'indices': [], 'deltas': [] } )
+                    t = targets[ _ids[name] ]
+                    t['indices'].append( indices + _offset )
+                    t['deltas'].append( deltas.ravel() )
+
+                _offset += nv
+
+            _kept = 0
+            for t in targets:
+                t['indices'] = numpy.concatenate( t['indices'] )
+                t['deltas'] = numpy.concatenate( t['deltas'] )
+                _kept += len(t['indices'])
+
+                if dense:
+                    _v = numpy.array( self.db['vertices'], numpy.float64 ).reshape(-1, 3)
+                    numpy.add.at( _v, t.pop('indices'), t.pop('deltas').reshape(-1, 3) )
+                    t['vertices'] = roundArray( _v, DECIMALS_VERTICES ).ravel()
+
+            if targets:
+                self.db['morphTargets'] = targets
+                self.db['metadata']['morphTargets'] = len(targets)
+
+            _r['count'] = _kept
+            print '# Morph targets: %d (%d blendShape targets), %d deltas kept' % (len(targets), _count, _kept)
+
+
+
+    def reduceAnimation(self, posTolerance=10**-DECIMALS_POS, rotTolerance=10**-DECIMALS_ROT):
+        # drop the animation keys that interpolating their neighbours rebuilds within tolerance, see reduceKeys
+        # pos and rot are reduced apart so a key may keep only one of them, the closing {'time': length} key stays
+
+        anims = self.db.get('animations', [])
+        if 'animation' in self.db:
+            anims = [ self.db['animation'] ] + anims
+        if not anims:
+            return
+        if numpy is None:
+            raise RuntimeError('animation reduction needs numpy')
+
+        with self.report.stage('reduce') as _r:
+            before = after = 0
+
+            for _inf in [ h for anim in anims for h in anim['hierarchy'] ]:
+                _keys = _inf['keys'][:-1]
+                if not _keys:
+                    continue
+                _times = numpy.array( [ k['time'] for k in _keys ], numpy.float64 )
+
+                keep = {}
+                for c, tolerance, spherical in ( ('pos', posTolerance, False), ('rot', rotTolerance, True) ):
+                    ids = [ i for i,k in enumerate(_keys) if c in k ]
+                    before += len(ids)
+                    if not ids:
+                        continue
+                    values = numpy.array( [ _keys[i][c] for i in ids ], numpy.float64 )
+                    keep[c] = set( ids[i] for i in reduceKeys(_times[ids], values, tolerance, spherical) )
+                    after += len(keep[c])
+
+                reduced = []
+                for i,k in enumerate(_keys):
+                    _key = dict( (c, v) for c,v in k.items() if c not in keep or i in keep[c] )
+                    if len(_key) > 1:
+                        reduced.append(_key)
+
+                _inf['keys'] = reduced + _inf['keys'][-1:]
+
+            _r['count'] = after
+            _r['ratio'] = float(before) / (after or 1)
+            print '# Animation keys: %d -> %d (x%.2f)' % (before, after, _r['ratio'])
+
+
+
+    def encode(self, compact=False):
+
+        with self.report.stage('encode') as r:
+            dump = ''.join( self.iterencode(self.db, compact) )
+            r['count'] = len(dump)
+        return dump
+
+
+
+    def iterencode(self, o, compact=False, indent=''):
+        # generator yielding the json text of o chunk by chunk
+        # scalars are buffered and joined every ENCODE_CHUNK items so big arrays never build one huge string
+
+        if isinstance(o, dict):
+            keys = orderedKeys(o)
+            _indent = indent + ' '*ENCODE_INDENT
+
+            if compact:
+                yield '{'
+            else:
+                yield '{\n'
+
+            last = len(keys)-1
+            for i,key in enumerate(keys):
+                if compact:
+                    yield '"%s":' % key
+                else:
+                    yield '%s"%s": ' % (_indent, key)
+
+                for chunk in self.iterencode(o[key], compact, _indent):
+                    yield chunk
+
+                if compact:
+                    if i!=last:
+                        yield ','
+                elif i!=last:
+                    yield ',\n'
+                else:
+                    yield '\n'
+
+            if compact:
+                yield '}'
+            else:
+                yield '%s}' % indent
+
+        elif isArray(o):
+            sep = ','
+            if not compact and len(o) < 6:
+                sep = ', '
+
+            yield '['
+            for i in xrange(0, len(o), ENCODE_CHUNK):
+                if i:
+                    yield sep
+                yield sep.join( map(str, o[i:i+ENCODE_CHUNK].tolist()) )
+            yield ']'
+
+        elif isinstance(o, list) or isinstance(o, tuple):
+            sep = ','
+            if not compact and len(o) < 6:
+                sep = ', '
+
+            buf = ['[']
+            for i,e in enumerate(o):
+                if i:
+                    buf.append(sep)
+
+                if isinstance(e, dict) or isinstance(e, list) or isinstance(e, tuple) or isArray(e):
+                    if isinstance(e, dict) and not compact:
+                        buf.append('\n%s' % indent)
+                    yield ''.join(buf)
+                    buf = []
+                    for chunk in self.iterencode(e, compact, indent):
+                        yield chunk
 
-                skin = msh.listHistory( type='skinCluster' )
-                if skin:
-                    skin = skin[0]
                 else:
-                    skin = None
+                    buf.append( encodeScalar(e) )
+                    if len(buf) > ENCODE_CHUNK:
+                        yield ''.join(buf)
+                        buf = []
+
+            buf.append(']')
+            yield ''.join(buf)
 
-                if skin:
-                    infs = skin.getInfluence()
-                    for inf in infs:
-                        if not inf in self.infs:
-                            self.infs.append(inf)
+        else:
+            yield encodeScalar(o)
+
+
+
+    def encodeBinary(self, uri, quantize=False, db=None):
+        # json header and typed arrays of the db (self.db by default) for the binary output
+        # buffers are replaced in the header by accessors into the file `uri`, see BinaryBuffer
+        # quantize: store floats as integers rounded at their DECIMALS_* instead of float32
+
+        if numpy is None:
+            raise RuntimeError('binary output needs numpy')
+
+        if db is None:
+            db = self.db
+
+        with self.report.stage('encode') as r:
+            buf = BinaryBuffer(quantize)
+            header = dict(db)
+
+            header['vertices'] = buf.add( db['vertices'], 3, DECIMALS_VERTICES )
+            if 'normalEncoding' in db['metadata']:
+                header['normals'] = buf.add( db['normals'], 2 )
+            else:
+                header['normals'] = buf.add( db['normals'], 3, DECIMALS_NORMALS )
+            header['uvs'] = [ buf.add( uvs, 2, DECIMALS_UVS ) for uvs in db['uvs'] ]
+            header['colors'] = buf.add( db['colors'] )
+            if 'indices' in db:
+                header['indices'] = buf.add( db['indices'] )
+            else:
+                header['faces'] = buf.add( db['faces'] )
+
+            if 'skinIndices' in db:
+                header['skinIndices'] = buf.add( db['skinIndices'], db['influencesPerVertex'] )
+                header['skinWeights'] = buf.add( db['skinWeights'], db['influencesPerVertex'], DECIMALS_WEIGHTS )
+
+            if 'morphTargets' in db:
+                header['morphTargets'] = []
+                for t in db['morphTargets']:
+                    t = dict(t)
+                    if 'vertices' in t:
+                        t['vertices'] = buf.add( t['vertices'], 3, DECIMALS_VERTICES )
+                    else:
+                        t['indices'] = buf.add( t['indices'] )
+                        t['deltas'] = buf.add( t['deltas'], 3, DECIMALS_VERTICES )
+                    header['morphTargets'].append(t)
+
+            if 'animation' in db:
+                header['animation'] = packAnimation( db['animation'], buf )
+            if 'animations' in db:
+                header['animations'] = [ packAnimation( anim, buf ) for anim in db['animations'] ]
 
+            header['buffer'] = { 'uri': uri, 'byteLength': buf.size }
+            r['count'] = buf.size
 
-                    # export weights
-                    # convert skinCluster with 2 bones per vertex
-                    infid = [self.infs.index(x) for x in infs]
+        return header, buf.arrays
 
-                    weights = []
-                    for wmap in skin.getWeights(msh):
-                        weights.append(wmap)
 
-                    for w in weights:
-                        if len(infid)>1:
-                            w = zip(infid,w)
-                            w = sorted(w, key=lambda vweight: vweight[1])[-2:]
-                            n = w[0][1]+w[1][1]
 
-                            self.db['skinIndices'].append(w[1][0])
-                            self.db['skinIndices'].append(w[0][0])
-                            w1 = round( w[1][1]/n, DECIMALS_WEIGHTS )
-                            w0 = round( w[0][1]/n, DECIMALS_WEIGHTS )
-                            self.db['skinWeights'].append(w1)
-                            self.db['skinWeights'].append(w0)
+    def write(self, name, path, dump=True, compact=False, binary=False, quantize=False, octNormals=False,
+              textureWorkers=TEXTURE_WORKERS, bakeResolution=BAKE_RESOLUTION ):
+        #todo: check path validity
+        #todo: confirm overwrite
+        # dump: json.dumps text, the indented encode() text otherwise, both streamed to the file
+        # binary: write the buffers to name.bin as typed arrays, name.js only holds the json header
+        # quantize: binary floats stored as integers rounded at their DECIMALS_*
+        # octNormals: binary and compact output store normals as two integers, see octEncode
+        # textureWorkers: texture files copied at once, see copyTextures
+        # bakeResolution: width and height of the images procedural textures are baked into, see bakeTextures
 
+
+        #copy/generate texture file
+        self.bakeTextures( os.path.join(path, name), bakeResolution )
+        files = self.copyTextures( os.path.join(path, name), textureWorkers )
+
+        for m in self.textures:
+            f = m.get('file')
+            if f in files:
+                self.db['materials'][ m['id'] ][ m['mode'] ] = '%s/%s' % (name, files[f])
+
+
+        # write json files, the levels of detail next to the main one
+        self.writeModel( self.db, name, path, dump, compact, binary, quantize, octNormals )
+
+        for i,level in enumerate(self.lods):
+            db = dict(self.db)
+            db.pop('morphTargets', None)
+            db.update(level['db'])
+            db['metadata'] = dict(self.db['metadata'])
+            db['metadata'].pop('lods')
+            db['metadata'].pop('morphTargets', None)
+            db['metadata'].update(level['db']['metadata'])
+            self.writeModel( db, '%s_lod%d' % (name, i+1), path, dump, compact, binary, quantize, octNormals )
+
+
+
+    def bakeTextures(self, folder, resolution=BAKE_RESOLUTION):
+        # sample the procedural texture networks of the materials into images, which become their 'file'
+        # identical networks are baked once: images are keyed by the digest of their attribute values
+        # (see MayaScene.network) and the resolution, and kept in the cache folder (or folder without cache)
+        # so networks left unchanged aren't baked again by the next exports
+        # maya commands only run on the main thread: bakes run one after the other, they are copied in parallel
+
+        pending = [ m for m in self.textures if m.get('bake') is not None ]
+        if not pending:
+            return
+
+        if self.cache is not None:
+            folder = self.cache.path
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with self.report.stage('bake') as r:
+            self.scene.progressStart( "Baking textures", len(pending) )
+            try:
+                images = {}
+                baked = 0
+                for m in pending:
+                    key = cacheKey( digest( [ self.scene.network(m['bake']), resolution ] ) )
+
+                    if key not in images:
+                        image = os.path.join(folder, key + BAKE_EXT)
+                        if os.path.isfile(image):
+                            os.utime(image, None)
                         else:
-                            self.db['skinWeights'].append(1)
-                            self.db['skinWeights'].append(0)
-                            self.db['skinIndices'].append(infid[0])
-                            self.db['skinIndices'].append(-1)
+                            self.scene.progress( 'baking %s...' % m['bake'] )
+                            try:
+                                self.scene.bake( m['bake'], image, resolution )
+                                baked += 1
+                            except Exception as err:
+                                print '# Warning: could not bake %s: %s' % (m['bake'], err)
+                            if not os.path.isfile(image):
+                                image = None
+                        images[key] = image
+
+                    if images[key] is not None:
+                        m['file'] = images[key]
+                    self.scene.progress( step=1 )
+            finally:
+                self.scene.progressEnd()
+
+            r['count'] = len(pending)
+            r['baked'] = baked
+            r['reused'] = len(images) - baked
+            print '# Bakes: %d networks for %d maps, %d baked, %d reused' % ( len(images), len(pending), baked, len(images) - baked )
+
+
+
+    def copyTextures(self, folder, workers=TEXTURE_WORKERS):
+        # copy the texture files of the materials to folder, returns the name each source file got there
+        # a file used by several materials is copied once, so are files of the same content (see fileDigest)
+        # files already there with the same size and modification time, or the same content, aren't copied again
+        # copies run in a pool of `workers` threads
+
+        with self.report.stage('textures') as r:
+            sources = []
+            for m in self.textures:
+                f = m.get('file')
+                if f and f not in sources:
+                    if os.path.isfile(f):
+                        sources.append(f)
+                    else:
+                        print '# Warning: texture file not found: %s' % f
 
+            r['count'] = len(sources)
+            if not sources:
+                return {}
 
+            pool = None
+            if workers != 1 and len(sources) > 1:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool( min(workers or multiprocessing.cpu_count(), len(sources)) )
+            _map = pool.map if pool is not None else map
+
+            try:
+                # only files sharing their size with another one can be duplicates, those get hashed
+                sizes = dict( (f, os.path.getsize(f)) for f in sources )
+                bysize = {}
+                for f in sources:
+                    bysize.setdefault( sizes[f], [] ).append(f)
+                hashed = [ f for f in sources if len(bysize[sizes[f]]) > 1 ]
+                digests = dict( zip( hashed, _map(fileDigest, hashed) ) )
+
+                # name in folder of each distinct file, suffixed when two files share a base name
+                names = {}
+                files = {}
+                copies = []
+                for f in sources:
+                    key = (sizes[f], digests.get(f, f))
+                    if key not in names:
+                        base, ext = os.path.splitext( os.path.basename(f) )
+                        n = base + ext
+                        i = 1
+                        while n in names.values():
+                            n = '%s_%d%s' % (base, i, ext)
+                            i += 1
+                        names[key] = n
+                        copies.append( (f, os.path.join(folder, n)) )
+                    files[f] = names[key]
+
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                copied = _map(copyTexture, copies)
+
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+            r['copied'] = sum( 1 for c in copied if c is not None )
+            r['skipped'] = len(copied) - r['copied']
+            r['bytes'] = sum( c for c in copied if c is not None )
+            print '# Textures: %d files for %d maps, %d copied (%.1f MB), %d up to date, %d duplicates' % (
+                len(copies), len([m for m in self.textures if m.get('file')]), r['copied'], r['bytes'] / 2.0**20,
+                r['skipped'], len(sources) - len(copies) )
+
+        return files
+
+
+
+    def writeModel(self, db, name, path, dump=True, compact=False, binary=False, quantize=False, octNormals=False):
+        # write a db to name.js, and name.bin for the binary output
+
+        js = path+'/'+name+'.js'
+
+        if octNormals and (binary or compact):
+            db = dict(db)
+            db['normals'] = octEncode( db['normals'] )
+            db['metadata'] = dict( db['metadata'], normalEncoding='oct%d' % OCT_BITS )
+
+        if binary:
+            header, arrays = self.encodeBinary( name+'.bin', quantize, db )
+
+            with self.report.stage('write', name) as r:
+                f = open(path+'/'+name+'.bin', 'wb')
+                try:
+                    for a in arrays:
+                        f.write( a.tobytes() )
+                    r['count'] = f.tell()
+                finally:
+                    f.close()
+
+                f = open(js, 'w')
+                try:
+                    for chunk in self.iterencode(header, compact):
+                        f.write(chunk)
+                    r['count'] += f.tell()
+                finally:
+                    f.close()
+            return
+
+        with self.report.stage('write', name) as r:
+            f = open(js,'w')
+            try:
+                # dump: the text of json.dumps, written piece by piece (json.dump would fall back to the python encoder)
+                if dump:
+                    chunks = dumpChunks( db, (',',':') if compact else (', ',': ') )
                 else:
+                    chunks = self.iterencode(db, compact)
+                for chunk in chunks:
+                    f.write(chunk)
+                r['count'] = f.tell()
+            finally:
+                f.close()
+
+
+
+
+
+class Report(object):
+    # wall time, cpu time, element count and peak memory of each export stage
+    # geometry stages (extract, build, merge) get one record per mesh
+    # profile: run the stages under cProfile as well
+
+    def __init__(self, profile=False):
+
+        self.records = []
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self._depth = 0
+
+
+    @contextlib.contextmanager
+    def stage(self, name, mesh=None):
+        # record the block as a stage, the yielded record can get a 'count'
+
+        record = { 'stage': name, 'mesh': mesh, 'count': None }
+        self.records.append(record)
+
+        rss = peakMemory()
+        wall, cpu = time.time(), cpuTime()
+        if self.profiler and not self._depth:
+            self.profiler.enable()
+        self._depth += 1
+
+        try:
+            yield record
+        finally:
+            self._depth -= 1
+            if self.profiler and not self._depth:
+                self.profiler.disable()
+
+            record['wall'] = time.time() - wall
+            record['cpu'] = cpuTime() - cpu
+            record['rss'] = peakMemory()
+            if rss is not None:
+                record['rssDelta'] = record['rss'] - rss
+
+
+    def add(self, record):
+        self.records.append(record)
+
+
+    def totals(self):
+        # wall, cpu and count summed by stage
+        totals = {}
+        for r in self.records:
+            t = totals.setdefault( r['stage'], {'wall':0.0, 'cpu':0.0, 'count':0, 'records':0} )
+            t['wall'] += r['wall']
+            t['cpu'] += r['cpu']
+            t['count'] += r['count'] or 0
+            t['records'] += 1
+        return totals
+
+
+    def slowest(self, stage=None, count=10):
+        # the slowest records, of a single stage if given
+        records = [ r for r in self.records if r['mesh'] is not None and (stage is None or r['stage'] == stage) ]
+        return sorted( records, key=lambda r: r['wall'], reverse=True )[:count]
+
+
+    def profile(self, count=50, sort='cumulative'):
+        # most expensive functions of the profiled stages, as dicts
+        # sort: 'cumulative', 'time' or 'calls'
+        if sort not in ('cumulative', 'time', 'calls'):
+            raise ValueError("profile sort must be 'cumulative', 'time' or 'calls', not %r" % sort)
+        if self.profiler is None:
+            return []
+
+        import pstats
+        stats = pstats.Stats(self.profiler)
+        rows = []
+        for (path, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+            rows.append( {
+                'function': '%s:%s(%s)' % (os.path.basename(path), line, func),
+                'calls': nc,
+                'time': tt,
+                'cumulative': ct,
+                } )
+        rows.sort( key=lambda r: r[sort], reverse=True )
+        return rows[:count]
+
+
+    def dump(self, path, profile=50):
+        # write records, totals and the top of the profile to a json file
+        f = open(path, 'w')
+        try:
+            json.dump( {
+                'records': self.records,
+                'totals': self.totals(),
+                'profile': self.profile(profile),
+                }, f, indent=2, sort_keys=True )
+        finally:
+            f.close()
+
+
+    def dumpProfile(self, path):
+        # raw cProfile stats, for pstats or any profile viewer
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+
+
+    def __str__(self):
+        lines = [ '%-12s %10s %10s %12s %6s' % ('stage', 'wall', 'cpu', 'count', 'calls') ]
+        for name, t in sorted( self.totals().items(), key=lambda x: -x[1]['wall'] ):
+            lines.append( '%-12s %9.3fs %9.3fs %12s %6s' % (name, t['wall'], t['cpu'], t['count'], t['records']) )
+        return '\n'.join(lines)
+
+
+
+
+
+class BinaryBuffer(object):
+    # typed little endian arrays laid out one after the other in a .bin file
+    # add() returns the accessor the json header keeps in place of the values:
+    #   type       javascript typed array to view the bytes with (Float32Array, Uint16Array...)
+    #   offset     byte offset in the file
+    #   count      number of values
+    #   itemSize   values per vertex, uv, key...
+    #   scale      quantized floats only, factor giving back the value out of the integer
+
+    def __init__(self, quantize=False):
+
+        self.quantize = quantize
+        self.arrays = []
+        self.size = 0
+
+
+    def add(self, values, itemSize=1, decimals=None):
+        # floats are given their decimals, integers none
+
+        if not self.quantize:
+            a, kind, scale = packArray(values, None, decimals is None)
+        else:
+            a, kind, scale = packArray(values, decimals, decimals is None)
+
+        pad = -self.size % BINARY_ALIGN
+        if pad:
+            self.arrays.append( numpy.zeros(pad, numpy.uint8) )
+            self.size += pad
+
+        accessor = { 'type': kind, 'offset': self.size, 'count': len(a), 'itemSize': itemSize }
+        if scale is not None:
+            accessor['scale'] = scale
+
+        self.arrays.append(a)
+        self.size += a.nbytes
+        return accessor
+
+
+
+
+
+class Palette(object):
+    # distinct values shared by the shapes of a db (colors, normal keys), numbered in order of addition
+    # arrays are looked up in a sorted copy of the values, kept sorted as values are added
+    # lists through a dict
+
+    def __init__(self):
+
+        self.count = 0
+        self.index = {}
+        self.sorted = None
+        self.order = None
+
+
+    def add(self, values):
+        # palette index of each of the distinct values of a shape, adding the missing ones
+        # returns the indices and the mask of the values that were new to the palette
+        if numpy is None or not isArray(values):
+            table = []
+            new = []
+            for v in values:
+                i = self.index.get(v)
+                new.append( i is None )
+                if i is None:
+                    i = self.index[v] = self.count
+                    self.count += 1
+                table.append(i)
+            return table, new
+
+        if self.sorted is None:
+            self.sorted = numpy.empty(0, values.dtype)
+            self.order = numpy.empty(0, numpy.int64)
+
+        pos = numpy.searchsorted(self.sorted, values)
+        found = numpy.zeros(len(values), bool)
+        inside = pos < len(self.sorted)
+        found[inside] = self.sorted[ pos[inside] ] == values[inside]
+        new = ~found
+
+        table = numpy.empty(len(values), numpy.int64)
+        table[found] = self.order[ pos[found] ]
+        table[new] = self.count + numpy.arange( new.sum() )
+        self.count += int( new.sum() )
+
+        # new values go in at their sorted position, several at the same position in value order
+        byvalue = numpy.argsort( values[new], kind='mergesort' )
+        at = pos[new][byvalue]
+        self.sorted = numpy.insert( self.sorted, at, values[new][byvalue] )
+        self.order = numpy.insert( self.order, at, table[new][byvalue] )
+        return table, new
+
+
+
+
+
+class GeometryCache(object):
+    # built shapes kept on disk between exports, one pickle file per content fingerprint (see cacheKey)
+    # reading an entry marks it as recently used, evict() removes the oldest ones above size bytes
+    # baked texture images are kept in the same folder and evicted the same way, see Exporter.bakeTextures
+
+    def __init__(self, path, size=CACHE_SIZE):
+
+        self.path = path
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        # several exports may share the folder, from batch processes running side by side:
+        # entries are written to their own temporary file and renamed, files may vanish at any time
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+
+    def get(self, key):
+
+        path = os.path.join(self.path, key + CACHE_EXT)
+        try:
+            f = open(path, 'rb')
+            try:
+                entry = cPickle.load(f)
+            finally:
+                f.close()
+            os.utime(path, None)
+        except Exception:
+            # missing or unreadable, it will be written again
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+
+    def put(self, key, entry):
+
+        path = os.path.join(self.path, key + CACHE_EXT)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            replaceFile(tmp, path)
+        except OSError:
+            # another process wrote the entry meanwhile, and windows won't rename over it
+            pass
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+    def evict(self):
+        # remove the least recently used entries until the cache fits in its size
+        # files removed meanwhile by another process are skipped
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(CACHE_EXT) or name.endswith(BAKE_EXT):
+                path = os.path.join(self.path, name)
+                try:
+                    files.append( (os.path.getmtime(path), os.path.getsize(path), path) )
+                except OSError:
                     pass
-                    #mais pas oublier de faire les mesh non anime aussi
 
+        total = sum( f[1] for f in files )
+        for mtime, size, path in sorted(files):
+            if total <= self.size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
 
-            self.bones  = []
 
-            for inf in self.infs:
-                b = {}
-                b['name'] = str(inf).split('|')[-1].split(':')[-1]
 
-                b['parent'] = -1
-                _parent = None
-                for p in inf.getAllParents():
-                    if p in self.infs:
-                        _parent = p
-                        b['parent'] = self.infs.index(p)
-                        break
 
-                _m = pm.dt.TransformationMatrix( inf.worldMatrix.get() )
-                if _parent:
-                    _m *= _parent.worldInverseMatrix.get()
 
-                b['pos'] = roundList( _m.getTranslation('transform'), DECIMALS_POS )
-                b['rotq'] = roundList( _m.getRotationQuaternion(), DECIMALS_ROT )
+class MayaScene(object):
+    # everything the Exporter reads from maya goes through this object
+    # threeMayaMock.MockScene implements the same methods on synthetic data
 
-                self.bones.append(b)
+    def __init__(self, bulk=True):
 
+        if pm is None:
+            raise RuntimeError('maya is not available')
 
-            self.db['metadata']['bones'] = len(self.bones)
-            self.db['bones'] = self.bones
+        # bulk: read mesh buffers at once through numpy, face by face otherwise
+        self.bulk = bulk and numpy is not None
 
+        # buffers read by fingerprint, by (shape, colors, local), until buffers() or release() takes them
+        self._reads = {}
 
+        # shader network strings of the materials and textures read by the current export, see reset
+        self._networks = {}
 
+        # no progress window in batch mode (mayapy, maya -batch)
+        self.gui = om.MGlobal.mayaState() == om.MGlobal.kInteractive
 
 
-    def exportAnimation(self, _start, _end):
 
-            self.infs = [pm.PyNode(str(x)) for x in self.infs]
+    def reset(self):
+        # start of an export: forget what was read by the previous one, the scene may have changed since
+        self._reads = {}
+        self._networks = {}
 
-            # export simple anim
-            _keys = pm.keyframe(self.infs, query=True, timeChange=True)
 
-            if _keys:
-                anim = {}
-                self.db['animation'] = anim
 
-                anim['name'] = 'anim0'
+    def release(self, shp):
+        # drop the buffers fingerprint kept for a shape that won't be read: built from the cache, or an instance
+        for key in [ k for k in self._reads if k[0] == str(shp) ]:
+            del self._reads[key]
 
-                fps = dict(
-                    game = 15,
-                    film = 24,
-                    pal = 25,
-                    ntsc = 30,
-                    show = 48,
-                    palf = 50,
-                    ntscf = 60
-                    )[ pm.currentUnit(query=True, time=True) ]
 
-                anim['fps'] = fps
 
-                anim['hierarchy'] = []
+    def shaderNetwork(self, node, names=True):
+        # shaderNetwork of a node, read once per export (materials are shared by many shapes)
+        key = (str(node), names)
+        if key not in self._networks:
+            self._networks[key] = shaderNetwork(node, names)
+        return self._networks[key]
 
-                for i,inf in enumerate(self.infs):
-                    _inf = {}
 
-                    _parent = self.bones[i]['parent']
-                    _inf['parent'] = _parent
 
-                    if _parent != -1:
-                        _parent = self.infs[_parent]
-                    else:
-                        _parent = None
+    def meshes(self, *args):
+        # (transform, shape) of the visible meshes under the given transforms, or under the selection
+
+        nodes = pm.ls(args, et='transform')
+        if not nodes:
+            nodes = pm.selected(et='transform')
+
+        _sl = pm.selected()
+        pm.select(nodes, hi=1)
+        nodes = pm.selected()
+        pm.select(_sl)
+
+        geo = []
+        for node in pm.ls(nodes, et='mesh'):
+            msh = node.getParent()
+            if not msh in geo:
+                geo.append(msh)
+
+        meshes = []
+        for node in geo:
+            for shp in node.getShapes():
+                if isinstance(shp, pm.nt.Mesh) and shp.io.get()==0 and shp.isVisible():
+                    meshes.append( (node, shp) )
+
+        return meshes
+
+
+
+    def shading(self, shp):
+        # materials of the shape and the index in that list of each face's one
+
+        dag = shp.__apiobject__()
+        mshfn = om.MFnMesh(dag)
+
+        # shading groups and the index of each face's one in sgs
+        sgs, sgf = connectedShaders(mshfn, dag)
+
+        if sgs is None:
+            sgs = []
+            sgf = array('i', [0]) * mshfn.numPolygons()
+
+            def faces(x, slot):
+              for fs in x:
+                if fs.startswith('f'):
+                  fs = fs.split('[')[1].split(']')[0]
+                  if ':' in fs:
+                    a, b = fs.split(':')
+                    a, b = int(a), int(b)
+                  else:
+                    a = b = int(fs)
+                  sgf[a:b+1] = array('i', [slot]) * (b+1-a)
+
+            _o = shp.instObjGroups[0].objectGroups.outputs(type='shadingEngine')
+            if _o:
+                # multi mat
+                for _id in shp.instObjGroups[0].objectGroups.getArrayIndices():
+                    og = shp.instObjGroups[0].objectGroups[_id]
+                    _comps = og.objectGrpCompList.get()
+
+                    _sg = og.outputs()
+                    if _sg and _comps:
+                        faces( _comps, len(sgs) )
+                        sgs.append(_sg[0])
+
+            else:
+                # single mat
+                _o = shp.instObjGroups[0].outputs(type='shadingEngine')
+                sgs += _o
+
+        return [ sg.surfaceShader.inputs()[0] for sg in sgs ], sgf
+
 
-                    _inf['keys'] = []
-                    #_start = min(_keys)
-                    #_end = max(_keys)
-                    anim['length'] = round( (_end-_start)/float(anim['fps']), DECIMALS_TIME )
 
-                    for frame in xrange( int(_end - _start) ):
-                        _t = frame+_start
+    def shapeInfo(self, shp):
 
-                        _key = {}
-                        _key['time'] = round( frame/float(fps), DECIMALS_TIME )
+        return {
+            'displayColors': shp.displayColors.get(),
+            'doubleSided': shp.doubleSided.get(),
+            'opposite': shp.opposite.get(),
+            }
 
-                        _m = pm.dt.TransformationMatrix( inf.worldMatrix.get(time=_t) )
-                        if _parent:
-                            _m *= _parent.worldInverseMatrix.get(time=_t)
 
-                        _key['pos'] = roundList( _m.getTranslation('transform'), DECIMALS_POS )
-                        _key['rot'] = roundList( _m.getRotationQuaternion(), DECIMALS_ROT )
-                        if frame==0:
-                            _key['scl'] = [1,1,1]
 
-                        _inf['keys'].append(_key)
+    def material(self, mat):
+        # three.js material attributes of a shader and the textures feeding it
 
-                    _inf['keys'].append( {'time': anim['length']} )
+        m = {}
+        textures = []
 
-                    anim['hierarchy'].append(_inf)
+        _nt = pm.nodeType(mat)
+        if _nt in ('lambert', 'phong', 'blinn', 'anisotropic'):
+            m['shading'] = 'Phong'
+            m['colorDiffuse'] = roundList( mat.color.get(), DECIMALS_COLOR )
+            _c = pm.dt.Vector(mat.ambientColor.get()) + mat.incandescence.get()
+            m['colorAmbient'] = roundList( _c, DECIMALS_COLOR )
+            #m['colorEmissive'] = mat.incandescence.get()
+            m['colorSpecular'] = [0,0,0]
 
+            self.setTextureInfo(m, textures, 'mapDiffuse', mat.color )
+            self.setTextureInfo(m, textures, 'mapLight', mat.ambientColor )
+            self.setTextureInfo(m, textures, 'mapBump', mat.normalCamera )
 
+            _t = mat.transparency.get()
+            _t = 1 - (_t[0]+_t[1]+_t[2]) / 3
+            if _t < 1:
+                m['transparency'] = _t
+                m['transparent'] = True
 
+        if _nt in ('phong', 'blinn', 'anisotropic'):
+            m['colorSpecular'] = roundList( mat.specularColor.get(), DECIMALS_COLOR )
+            m['specularCoef'] = 10
+            if _nt == 'blinn':
+                m['specularCoef'] = 4 / mat.eccentricity.get()
+            elif _nt == 'phong':
+                m['specularCoef'] = mat.cosinePower.get() * 2
+            if _nt == 'anisotropic':
+                m['specularCoef'] = 4 / mat.roughness.get()
 
 
-    def setTextureInfo(self, i, mode, attr ):
+            self.setTextureInfo(m, textures, 'mapSpecular', mat.specularColor )
+
+        if _nt == 'surfaceShader':
+            m['shading'] = 'Basic'
+            m['colorDiffuse'] = roundList( mat.outColor.get(), DECIMALS_COLOR )
+
+        return m, textures
+
+
+
+    def setTextureInfo(self, m, textures, mode, attr ):
 
         src = attr.inputs()
         ok = False
 
         if src:
             infos = {}
-            infos['id'] = i
             infos['mode'] = mode
 
             src = src[0]
@@ -598,130 +1755,230 @@ class Exporter(object):
         if ok:
 
             if mode == 'mapDiffuse':
-                del( self.db['materials'][i]['colorDiffuse'] )
+                del( m['colorDiffuse'] )
             if mode == 'mapSpecular':
-                del( self.db['materials'][i]['colorSpecular'] )
+                del( m['colorSpecular'] )
 
-            self.db['materials'][i]['%sRepeat'%mode] = (True, True)
+            m['%sRepeat'%mode] = (True, True)
 
-            self.textures.append(infos)
+            textures.append(infos)
 
         #options: 'Repeat', 'Offset', 'Wrap', 'Anisotropy'
         #mode bump: 'mapBumpScale', 'mapNormalFactor'
 
 
 
-    def encode(self, compact=False):
+    def buffers(self, shp, colors=False, local=False):
+        # raw buffers of the shape, see bulkBuffers
+        # local: points and normals in object space instead of world space
 
-        self.dump = ''
-        self.dump_indent = ''
-        self.dump_step = 2
+        # already read by fingerprint
+        raw = self._reads.pop( (str(shp), colors, local), None )
+        if raw is not None:
+            return raw
 
-        self.iterencode(self.db)
+        dag = shp.__apiobject__()
+        mshfn = om.MFnMesh(dag)
 
-        return self.dump
+        raw = None
+        if self.bulk:
+            raw = bulkBuffers(mshfn, dag, colors, local)
+        if raw is None:
+            raw = iterBuffers(mshfn, dag, colors, local)
+        return raw
 
 
 
-    def iterencode(self, o):
+    def fingerprint(self, shp, local=False):
+        # digest of everything the built shape depends on, None if it can't be read in bulk
+        # points (in world space, object space if local), topology, uvs, normals and colors,
+        # the shader networks and the shape flags
+        # the buffers read are kept for the buffers() call building the shape, see release
 
-        if isinstance(o, dict):
-            self.iterindent(1)
-            self.dump += '{\n'
-
-            keys = o.keys()
-            order = {}
-            for d in ORDERED_DICTS:
-                if len(order) < len( set(keys).intersection(d) ):
-                    order = {}
-                    for i,de in enumerate(d):
-                        order[de] = i
-            keys = sorted( keys, key=lambda k: order.get(k) )
+        if not self.bulk:
+            return None
 
-            last = len(keys)-1
-            for i,key in enumerate(keys):
-                self.dump += self.dump_indent
-                self.dump += '"%s": ' % key
+        dag = shp.__apiobject__()
+        infos = self.shapeInfo(shp)
+        raw = bulkBuffers( om.MFnMesh(dag), dag, infos['displayColors'], local )
+        if raw is None:
+            return None
+        self._reads[ (str(shp), infos['displayColors'], local) ] = raw
 
-                self.iterencode(o[key])
-                if i!=last:
-                    self.dump += ','
-                self.dump += '\n'
+        mats, faceShaders = self.shading(shp)
+        values = [ sorted(infos.items()), numpy.frombuffer(faceShaders, numpy.int32) ]
+        values += [ raw[k] for k in sorted(raw) ]
+        values += [ self.shaderNetwork(mat) for mat in mats ]
+        return digest(values)
 
-            self.iterindent(-1)
-            self.dump += '%s}' % self.dump_indent
 
-        elif isinstance(o, list) or isinstance(o, tuple):
-            self.dump += '['
 
-            last = len(o)-1
-            for i,e in enumerate(o):
-                if isinstance(e, dict):
-                    self.dump += '\n%s' % self.dump_indent
-                self.iterencode(e)
-                if i != last:
-                    self.dump += ','
-                    if last < 5:
-                        self.dump += ' '
+    def deformed(self, shp):
+        # whether a skinCluster or a blendShape deforms the shape
+        return any( shp.listHistory(type=t) for t in ('skinCluster', 'blendShape') )
 
-            self.dump += ']'
 
-        elif isinstance(o, bool):
-            if o: self.dump += 'true'
-            else: self.dump += 'false'
 
-        elif isinstance(o, str) or isinstance(o, unicode):
-            self.dump += '"%s"' % str(o)
+    def network(self, node):
+        # digest of a texture network, the same for identical networks of other nodes
+        return digest( [ self.shaderNetwork(node, False) ] )
 
-        else:
-            self.dump += str(o)
 
+    def bake(self, node, path, resolution):
+        # sample the color of a 2d texture network over its uv square into an image file
+        # convertSolidTx leaves a file texture node behind, it is removed
+        nodes = pm.convertSolidTx( node.outColor, samplePlane=True, resolutionX=resolution, resolutionY=resolution,
+                                   fileFormat=BAKE_EXT[1:], fileImageName=path, force=True )
+        if nodes:
+            pm.delete(nodes)
 
 
-    def iterindent(self, i):
 
-        v = len(self.dump_indent) + i*self.dump_step
-        self.dump_indent = ''
-        for i in xrange(v):
-            self.dump_indent += ' '
+    def skin(self, shp):
+        # influences of the shape skinCluster and the weights of each vertex on them, None if not deformed
+        # weights are a (vertices, influences) array in bulk mode, an iterable of lists otherwise
 
+        skin = shp.listHistory( type='skinCluster' )
+        if not skin:
+            return None
 
+        skin = skin[0]
+        if self.bulk:
+            weights = bulkWeights(skin, shp)
+            if weights is not None:
+                return skin.getInfluence(), weights
+        return skin.getInfluence(), skin.getWeights(shp)
 
-    def write(self, name, path, dump=True, compact=False ):
-        #todo: check path validity
-        #todo: confirm overwrite
 
 
-        #copy/generate texture file
-        map_folder = os.path.join( path, name )
+    def morphTargets(self, shp):
+        # (name, vertex indices, world space deltas) of each blendShape target deforming shp, one target at a time
 
-        for m in self.textures:
-            mode = m['mode']
-            i = m['id']
+        _m = worldMatrix( shp.__apimdagpath__() )
 
-            f = m.get('file')
-            if f:
-                if not os.path.exists(map_folder):
-                    os.makedirs(map_folder)
-                shutil.copyfile(f, os.path.join(map_folder, os.path.basename(f)) )
-            else:
-                bake = m.get('bake')
-                #todo: bake texture
+        for bs in shp.listHistory( type='blendShape' ):
+            geo = oma.MFnGeometryFilter( bs.__apiobject__() ).indexForOutputShape( shp.__apiobject__() )
 
-            if f:
-                self.db['materials'][i][mode] = '%s/%s' % (name, os.path.basename(f) )
+            for name, weight in bs.listAliases():
+                if not weight.isElement() or weight.array().attrName(longName=True) != 'weight':
+                    continue
+
+                # the deltas of a fully weighted target, sparse as maya stores them
+                item = bs.inputTarget[geo].inputTargetGroup[ weight.index() ].inputTargetItem[6000]
+                points = item.inputPointsTarget.get()
+                if not points:
+                    continue
+
+                deltas = numpy.array( [ tuple(p)[:3] for p in points ], numpy.float64 )
+                yield name, componentIndices( item.inputComponentsTarget.get() ), numpy.dot( deltas, _m[:3,:3] )
+
+
+
+    def parents(self, node):
+        # ancestors of a node, closest first
+
+        return node.getAllParents()
 
 
-        # write json file
-        js = path+'/'+name+'.js'
 
-        f = open(js,'w')
-        if not dump:
-            f.write( self.encode(compact) )
+    def worldMatrix(self, node, time=None):
+        # world matrix of a node as a 4x4 list, at the current time or at the given frame
+
+        if time is None:
+            _m = node.worldMatrix.get()
         else:
-            f.write( json.dumps(self.db) )
-        f.close()
+            _m = node.worldMatrix.get(time=time)
+        return [ [ _m[i][j] for j in xrange(4) ] for i in xrange(4) ]
+
+
+
+    def worldMatrices(self, nodes, times):
+        # world matrices of nodes at each of the given frames as a (frames, nodes, 4, 4) array, nested lists without numpy
+        # the scene is moved once to each frame and every node is read from there, then the current time is restored
+
+        paths = [ node.__apimdagpath__() for node in nodes ]
+        unit = om.MTime.uiUnit()
+        current = om.MAnimControl.currentTime()
+
+        matrices = []
+        try:
+            for t in times:
+                om.MAnimControl.setCurrentTime( om.MTime(t, unit) )
+                _ms = [ p.inclusiveMatrix() for p in paths ]
+                matrices.append( [ [ [ _m(i,j) for j in xrange(4) ] for i in xrange(4) ] for _m in _ms ] )
+        finally:
+            om.MAnimControl.setCurrentTime(current)
+
+        if numpy is not None:
+            return numpy.array(matrices, numpy.float64).reshape(len(times), len(paths), 4, 4)
+        return matrices
+
+
+
+    def keyTimes(self, nodes):
+
+        return pm.keyframe(nodes, query=True, timeChange=True)
+
+
+
+    def clips(self):
+        # (name, start, end) of the time editor clips, or of the time slider bookmarks if there is none
+        # end is excluded, like exportAnimation's
 
+        clips = []
+        for node in pm.ls(type='timeEditorClip'):
+            try:
+                _start = node.clip[0].clipStart.get()
+                clips.append( ( node.clip[0].clipName.get(), _start, _start + node.clip[0].clipDuration.get() ) )
+            except Exception:
+                # not a clip of its own (containers, older versions)
+                pass
+
+        if not clips:
+            for node in pm.ls(type='timeSliderBookmark'):
+                clips.append( ( node.attr('name').get(), node.timeRangeStart.get(), node.timeRangeStop.get() + 1 ) )
+
+        return sorted( clips, key=lambda c: (c[1], c[0]) )
+
+
+
+    def fps(self):
+
+        return dict(
+            game = 15,
+            film = 24,
+            pal = 25,
+            ntsc = 30,
+            show = 48,
+            palf = 50,
+            ntscf = 60
+            )[ pm.currentUnit(query=True, time=True) ]
+
+
+
+    def progressStart(self, title, count):
+
+        if not self.gui:
+            return
+        pm.progressWindow( endProgress=True )
+        pm.progressWindow( title=title, progress=0, status="", maxValue=count )
+
+
+    def progress(self, status=None, step=0):
+
+        if not self.gui:
+            return
+        if status is not None:
+            pm.progressWindow( edit=True, status=status )
+        if step:
+            pm.progressWindow( edit=True, step=step )
+
+
+    def progressEnd(self):
+
+        if not self.gui:
+            return
+        pm.progressWindow( endProgress=True )
 
 
 
@@ -732,3 +1989,1858 @@ def roundList(array, decimals=4):
         new.append(round(v,decimals))
     return new
 
+
+def roundArray(a, decimals=4):
+    # roundList of an array: ties go away from zero like python's round, not to even like numpy.round
+    # round works on the exact value of the float, so the few values landing on a tie once scaled
+    # (where float error may have made or hidden it) are rounded by round itself
+    a = numpy.asarray(a, numpy.float64)
+    scale = 10.0**decimals
+    y = numpy.abs(a) * scale
+    r = numpy.copysign( numpy.floor(y + 0.5) / scale, a )
+    near = numpy.flatnonzero( numpy.abs( y - numpy.floor(y) - 0.5 ) <= y * 1e-12 )
+    if len(near):
+        r.flat[near] = [ round(v, decimals) for v in a.flat[near].tolist() ]
+    return r
+
+
+def matrixMult(a, b):
+    # product of two 4x4 matrices as lists
+    return [ [ sum( a[i][k]*b[k][j] for k in xrange(4) ) for j in xrange(4) ] for i in xrange(4) ]
+
+
+def matrixInverse(m):
+    # inverse of an affine 4x4 matrix (maya row vectors, translation in the last row)
+    a = [ row[:3] for row in m[:3] ]
+    c = [
+        [ a[1][1]*a[2][2]-a[1][2]*a[2][1], a[0][2]*a[2][1]-a[0][1]*a[2][2], a[0][1]*a[1][2]-a[0][2]*a[1][1] ],
+        [ a[1][2]*a[2][0]-a[1][0]*a[2][2], a[0][0]*a[2][2]-a[0][2]*a[2][0], a[0][2]*a[1][0]-a[0][0]*a[1][2] ],
+        [ a[1][0]*a[2][1]-a[1][1]*a[2][0], a[0][1]*a[2][0]-a[0][0]*a[2][1], a[0][0]*a[1][1]-a[0][1]*a[1][0] ],
+        ]
+    det = a[0][0]*c[0][0] + a[0][1]*c[1][0] + a[0][2]*c[2][0]
+    inv = [ [ c[i][j]/det for j in xrange(3) ] for i in xrange(3) ]
+    t = [ -sum( m[3][k]*inv[k][j] for k in xrange(3) ) for j in xrange(3) ]
+    return [ inv[0]+[0.0], inv[1]+[0.0], inv[2]+[0.0], t+[1.0] ]
+
+
+def decomposeMatrix(m):
+    # translation and rotation quaternion (x, y, z, w) of a 4x4 matrix, scale and shear are dropped
+    r = []
+    for row in m[:3]:
+        l = sum( x*x for x in row[:3] ) ** 0.5 or 1.0
+        r.append( [ x/l for x in row[:3] ] )
+
+    # mirrored matrix: flip an axis to get back a rotation
+    det = ( r[0][0]*(r[1][1]*r[2][2]-r[1][2]*r[2][1])
+          - r[0][1]*(r[1][0]*r[2][2]-r[1][2]*r[2][0])
+          + r[0][2]*(r[1][0]*r[2][1]-r[1][1]*r[2][0]) )
+    if det < 0:
+        r[0] = [ -x for x in r[0] ]
+
+    # maya matrices are transposed compared to the usual column vector formulas
+    tr = r[0][0] + r[1][1] + r[2][2]
+    if tr > 0:
+        s = 0.5 / (tr+1.0) ** 0.5
+        q = [ (r[1][2]-r[2][1])*s, (r[2][0]-r[0][2])*s, (r[0][1]-r[1][0])*s, 0.25/s ]
+    elif r[0][0] > r[1][1] and r[0][0] > r[2][2]:
+        s = 2.0 * (1.0 + r[0][0] - r[1][1] - r[2][2]) ** 0.5
+        q = [ 0.25*s, (r[1][0]+r[0][1])/s, (r[2][0]+r[0][2])/s, (r[1][2]-r[2][1])/s ]
+    elif r[1][1] > r[2][2]:
+        s = 2.0 * (1.0 + r[1][1] - r[0][0] - r[2][2]) ** 0.5
+        q = [ (r[1][0]+r[0][1])/s, 0.25*s, (r[2][1]+r[1][2])/s, (r[2][0]-r[0][2])/s ]
+    else:
+        s = 2.0 * (1.0 + r[2][2] - r[0][0] - r[1][1]) ** 0.5
+        q = [ (r[2][0]+r[0][2])/s, (r[2][1]+r[1][2])/s, 0.25*s, (r[0][1]-r[1][0])/s ]
+
+    return list(m[3][:3]), q
+
+
+
+def localTransforms(world, parents):
+    # translation and rotation quaternion of every node relative to its parent, at every frame
+    # world: (frames, nodes, 4, 4) world matrices, parents: index of each node's parent in nodes, -1 for none
+    # returns (frames, nodes, 3) and (frames, nodes, 4) arrays, nested lists through decomposeMatrix without numpy
+    if numpy is None:
+        pos, rot = [], []
+        for frame in world:
+            pos.append([])
+            rot.append([])
+            for m,p in zip(frame, parents):
+                if p != -1:
+                    m = matrixMult( m, matrixInverse(frame[p]) )
+                _pos, _rot = decomposeMatrix(m)
+                pos[-1].append(_pos)
+                rot[-1].append(_rot)
+        return pos, rot
+
+    world = numpy.asarray(world, numpy.float64)
+    local = world.copy()
+    child = [ i for i,p in enumerate(parents) if p != -1 ]
+    if child:
+        _parents = [ parents[i] for i in child ]
+        local[:,child] = numpy.matmul( world[:,child], numpy.linalg.inv(world[:,_parents]) )
+
+    return local[...,3,:3], quaternions(local)
+
+
+def quaternions(m):
+    # decomposeMatrix rotations of a (..., 4, 4) array of matrices as a (..., 4) array
+    r = m[...,:3,:3].copy()
+    l = numpy.sqrt( (r*r).sum(-1) )
+    l[l==0] = 1.0
+    r /= l[...,None]
+
+    mirrored = numpy.linalg.det(r) < 0
+    r[mirrored,0] *= -1
+
+    r = r.reshape(-1, 3, 3)
+    q = numpy.empty( (len(r), 4) )
+    tr = r[:,0,0] + r[:,1,1] + r[:,2,2]
+
+    # the same four cases as decomposeMatrix, each one computed on its own matrices
+    c0 = tr > 0
+    c1 = ~c0 & (r[:,0,0] > r[:,1,1]) & (r[:,0,0] > r[:,2,2])
+    c2 = ~c0 & ~c1 & (r[:,1,1] > r[:,2,2])
+    c3 = ~c0 & ~c1 & ~c2
+
+    a = r[c0]
+    s = 0.5 / numpy.sqrt(tr[c0]+1.0)
+    q[c0] = numpy.column_stack( ( (a[:,1,2]-a[:,2,1])*s, (a[:,2,0]-a[:,0,2])*s, (a[:,0,1]-a[:,1,0])*s, 0.25/s ) )
+
+    a = r[c1]
+    s = 2.0 * numpy.sqrt(1.0 + a[:,0,0] - a[:,1,1] - a[:,2,2])
+    q[c1] = numpy.column_stack( ( 0.25*s, (a[:,1,0]+a[:,0,1])/s, (a[:,2,0]+a[:,0,2])/s, (a[:,1,2]-a[:,2,1])/s ) )
+
+    a = r[c2]
+    s = 2.0 * numpy.sqrt(1.0 + a[:,1,1] - a[:,0,0] - a[:,2,2])
+    q[c2] = numpy.column_stack( ( (a[:,1,0]+a[:,0,1])/s, 0.25*s, (a[:,2,1]+a[:,1,2])/s, (a[:,2,0]-a[:,0,2])/s ) )
+
+    a = r[c3]
+    s = 2.0 * numpy.sqrt(1.0 + a[:,2,2] - a[:,0,0] - a[:,1,1])
+    q[c3] = numpy.column_stack( ( (a[:,2,0]+a[:,0,2])/s, (a[:,2,1]+a[:,1,2])/s, 0.25*s, (a[:,0,1]-a[:,1,0])/s ) )
+
+    return q.reshape( m.shape[:-2] + (4,) )
+
+
+
+def reduceKeys(times, values, tolerance, spherical=False):
+    # sorted indices of the keys to keep so interpolating the others from them stays within tolerance
+    # values: (keys, n) array, linearly interpolated or slerped as quaternions when spherical
+    # split where the error is the largest until it fits (douglas-peucker), a constant track keeps its first key only
+    if keyError(values[0], values, spherical).max() <= tolerance:
+        return [0]
+
+    keep = [0, len(values)-1]
+    stack = [ (0, len(values)-1) ]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+
+        t = (times[a+1:b] - times[a]) / (times[b] - times[a])
+        if spherical:
+            _v = slerp(values[a], values[b], t)
+        else:
+            _v = values[a] + (values[b] - values[a]) * t[:,None]
+        err = keyError(_v, values[a+1:b], spherical)
+
+        i = err.argmax()
+        if err[i] > tolerance:
+            i += a+1
+            keep.append(i)
+            stack += [ (a, i), (i, b) ]
+
+    return sorted(keep)
+
+
+def keyError(a, b, spherical=False):
+    # largest component difference of each key, quaternions q and -q being the same rotation
+    err = abs(a - b).max(-1)
+    if spherical:
+        err = numpy.minimum( err, abs(a + b).max(-1) )
+    return err
+
+
+def slerp(a, b, t):
+    # quaternions (x, y, z, w) from a to b at each ratio of t, along the shortest arc as three.js does
+    d = numpy.dot(a, b)
+    if d < 0:
+        b, d = -b, -d
+
+    if d > 0.9995:
+        q = a + (b - a) * t[:,None]
+    else:
+        theta = numpy.arccos(d)
+        q = ( numpy.sin((1-t)*theta)[:,None]*a + numpy.sin(t*theta)[:,None]*b ) / numpy.sin(theta)
+    return q / numpy.sqrt( (q*q).sum(1) )[:,None]
+
+
+
+def cpuTime():
+    # user + system time of the process
+    t = os.times()
+    return t[0] + t[1]
+
+
+def peakMemory():
+    # peak resident memory of the process in MB, None if it can't be read
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return rss / 1048576.0
+        return rss / 1024.0
+
+    if sys.platform == 'win32':
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [ ('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong) ] + \
+                       [ (k, ctypes.c_size_t) for k in ( 'PeakWorkingSetSize', 'WorkingSetSize',
+                            'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                            'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage' ) ]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        try:
+            ok = ctypes.windll.psapi.GetProcessMemoryInfo( ctypes.windll.kernel32.GetCurrentProcess(),
+                                                           ctypes.byref(counters), counters.cb )
+        except Exception:
+            ok = False
+        if ok:
+            return counters.PeakWorkingSetSize / 1048576.0
+
+    return None
+
+
+
+def packArray(values, decimals=None, integer=False):
+    # flat typed array of a buffer, its javascript type name and the scale of quantized values
+    # integers, and floats quantized at `decimals`, get the smallest BINARY_INTS type holding them
+    # other floats are float32
+    if integer:
+        a = numpy.asarray(values, numpy.int64).ravel()
+        scale = None
+    elif decimals is None:
+        return numpy.asarray(values, '<f4').ravel(), 'Float32Array', None
+    else:
+        a = numpy.round( numpy.asarray(values, numpy.float64).ravel() * 10**decimals ).astype(numpy.int64)
+        scale = round( 10.0**-decimals, decimals )
+
+    lo = hi = 0
+    if len(a):
+        lo, hi = a.min(), a.max()
+    for kind, dtype in BINARY_INTS:
+        info = numpy.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return a.astype(dtype), kind, scale
+    raise ValueError('values out of the 32 bits range')
+
+
+def octEncode(normals, bits=OCT_BITS):
+    # flat xyz unit normals as flat pairs of signed integers of `bits` bits, octahedral mapping:
+    # the normal is projected on the |x|+|y|+|z| = 1 octahedron, the lower half folded over the upper one,
+    # and x,y of the projection scaled by 2**(bits-1)-1. decoded by x,y /= 2**(bits-1)-1, z = 1-|x|-|y|,
+    # and if z < 0: x,y = (1-|y|)*sign(x), (1-|x|)*sign(y)
+    if numpy is None:
+        raise RuntimeError('octahedral normals need numpy')
+
+    n = numpy.asarray(normals, numpy.float64).reshape(-1, 3)
+    n = n / numpy.maximum( numpy.abs(n).sum(1), 1e-12 )[:,None]
+    x, y, z = n[:,0], n[:,1], n[:,2]
+
+    sx = numpy.where(x >= 0, 1.0, -1.0)
+    sy = numpy.where(y >= 0, 1.0, -1.0)
+    lower = z < 0
+    ox = numpy.where( lower, (1 - numpy.abs(y)) * sx, x )
+    oy = numpy.where( lower, (1 - numpy.abs(x)) * sy, y )
+
+    scale = 2**(bits-1) - 1
+    return numpy.round( numpy.column_stack( (ox, oy) ) * scale ).astype(numpy.int64).ravel()
+
+
+def packAnimation(anim, buf):
+    # animation with its keys moved into buf
+    # pos, rot and scl keys of all bones are concatenated by channel into times and values arrays,
+    # each hierarchy entry keeps the [first, count] range of its keys in each of them
+    channels = ( ('pos', 3, DECIMALS_POS), ('rot', 4, DECIMALS_ROT), ('scl', 3, DECIMALS_POS) )
+    tracks = dict( (c, ([], [])) for c,n,d in channels )
+
+    hierarchy = []
+    for bone in anim['hierarchy']:
+        h = { 'parent': bone['parent'] }
+        for c,n,d in channels:
+            times, values = tracks[c]
+            keys = [ k for k in bone['keys'] if c in k ]
+            h[c] = [ len(times), len(keys) ]
+            times += [ k['time'] for k in keys ]
+            for k in keys:
+                values += k[c]
+        hierarchy.append(h)
+
+    anim = dict(anim)
+    anim['hierarchy'] = hierarchy
+    for c,n,d in channels:
+        times, values = tracks[c]
+        anim[c] = {
+            'times': buf.add( times, 1, DECIMALS_TIME ),
+            'values': buf.add( values, n, d ),
+            }
+    return anim
+
+
+
+def cacheKey(fingerprint):
+    # GeometryCache key of a shape fingerprint, entries written by another version or rounding are not read back
+    decimals = (DECIMALS_VERTICES, DECIMALS_UVS, DECIMALS_NORMALS, DECIMALS_COLOR)
+    return hashlib.sha1( '%s %s %s' % (__version__, decimals, fingerprint) ).hexdigest()
+
+
+def digest(values):
+    # sha1 of a sequence of arrays, lists and strings
+    h = hashlib.sha1()
+    for v in values:
+        if isArray(v):
+            h.update( str(v.dtype) )
+            h.update( numpy.ascontiguousarray(v).tobytes() )
+        else:
+            h.update( repr(v) )
+    return h.hexdigest()
+
+
+
+def fileDigest(path, chunk=TEXTURE_CHUNK):
+    # sha1 of a file content, read chunk bytes at a time
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def replaceFile(src, dst):
+    # rename src over dst, atomic on posix
+    # windows doesn't rename over an existing file, it is removed first (maybe by another process too)
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        os.rename(src, dst)
+
+
+def copyTexture(job):
+    # copy a (source, destination) file unless the destination already holds it, returns the bytes copied or None
+    # same size and modification time is taken as up to date, same size only has the contents compared
+    # copies go to a temporary file first so a killed export never leaves a truncated texture
+    src, dst = job
+
+    if os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src):
+        if int(os.path.getmtime(dst)) == int(os.path.getmtime(src)) or fileDigest(dst) == fileDigest(src):
+            return None
+
+    shutil.copy2(src, dst + '.tmp')
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(dst + '.tmp', dst)
+    return os.path.getsize(dst)
+
+
+def orderedKeys(o):
+    # sort dict keys with the ORDERED_DICTS sequence matching most of them
+    keys = o.keys()
+    order = {}
+    for d in _ORDERS:
+        if len(order) < len( set(keys).intersection(d) ):
+            order = d
+    return sorted( keys, key=lambda k: order.get(k) )
+
+_ORDERS = [ dict( (k,i) for i,k in enumerate(d) ) for d in ORDERED_DICTS ]
+
+
+def encodeScalar(o):
+    if isinstance(o, bool):
+        if o: return 'true'
+        return 'false'
+    elif isinstance(o, str) or isinstance(o, unicode):
+        return '"%s"' % str(o)
+    elif o is None:
+        return 'null'
+    return str(o)
+
+
+def isArray(o):
+    return numpy is not None and isinstance(o, numpy.ndarray)
+
+
+def jsonDefault(o):
+    # json.dumps fallback for the numpy buffers stored in db
+    if isArray(o):
+        return o.tolist()
+    raise TypeError('%r is not JSON serializable' % o)
+
+
+def isLargeJson(o):
+    # whether dumpChunks writes o in several pieces: arrays, long lists, lists of containers,
+    # and dicts holding one of them (or a dict), everything else is small enough to be dumped at once
+    if isArray(o):
+        return True
+    if isinstance(o, dict):
+        return any( isinstance(v, dict) or isLargeJson(v) for v in o.itervalues() )
+    if isinstance(o, (list, tuple)) and o:
+        return len(o) > ENCODE_CHUNK or isinstance(o[0], (dict, list, tuple)) or isArray(o[0])
+    return False
+
+
+def dumpChunks(o, separators):
+    # the text of json.dumps(o), in pieces of ENCODE_CHUNK array items at most
+    # dicts are written key by key, arrays and long lists of scalars by slices, lists of containers item by item,
+    # so the C encoder still does the work and the whole text is never held in memory
+    if not isLargeJson(o):
+        yield json.dumps(o, separators=separators, default=jsonDefault)
+        return
+
+    item, key = separators
+    if isinstance(o, dict):
+        yield '{'
+        for i, (k, v) in enumerate(o.iteritems()):
+            yield ( item if i else '' ) + json.dumps(k if isinstance(k, basestring) else str(k)) + key
+            for chunk in dumpChunks(v, separators):
+                yield chunk
+        yield '}'
+
+    elif isArray(o) or not isLargeJson(o[:1]):
+        yield '['
+        for i in xrange(0, len(o), ENCODE_CHUNK):
+            _o = o[i:i+ENCODE_CHUNK]
+            if isArray(_o):
+                _o = _o.tolist()
+            yield ( item if i else '' ) + json.dumps(_o, separators=separators, default=jsonDefault)[1:-1]
+        yield ']'
+
+    else:
+        yield '['
+        for i, e in enumerate(o):
+            if i:
+                yield item
+            for chunk in dumpChunks(e, separators):
+                yield chunk
+        yield ']'
+
+
+
+def joinBuffers(buffers):
+    # concatenate per shape lists or numpy arrays into a single flat buffer
+    if numpy is not None and any( isinstance(b, numpy.ndarray) for b in buffers ):
+        return numpy.concatenate( [numpy.asarray(b) for b in buffers if len(b)] )
+    new = []
+    for b in buffers:
+        new += b
+    return new
+
+
+
+def rawArray(ptr, count, width=3):
+    # copy a float* returned by the api (swig pointer) into a (count, width) numpy array
+    buf = (ctypes.c_float * (count*width)).from_address( int(ptr) )
+    return numpy.frombuffer(buf, numpy.float32).reshape(count, width).astype(numpy.float64)
+
+
+def toArray(marray, dtype=None):
+    # copy an api array (MIntArray, MFloatArray...) into a numpy array
+    if dtype is None:
+        dtype = numpy.float64
+    return numpy.fromiter(marray, dtype, marray.length())
+
+
+def colorArray(mcolors):
+    # (n,4) numpy array out of a MColorArray, copied at once through a float[4] buffer
+    n = mcolors.length()
+    try:
+        util = om.MScriptUtil()
+        util.createFromList( [0.0] * (n*4), n*4 )
+        ptr = util.asFloat4Ptr()
+        mcolors.get(ptr)
+        return rawArray(ptr, n, 4)
+    except Exception:
+        _c = [ mcolors[i] for i in xrange(n) ]
+        return numpy.array( [ (c.r, c.g, c.b, c.a) for c in _c ], numpy.float64 ).reshape(-1, 4)
+
+
+def worldMatrix(dag):
+    _m = dag.inclusiveMatrix()
+    return numpy.array( [[_m(i,j) for j in xrange(4)] for i in xrange(4)] )
+
+
+def bulkPoints(mshfn, dag, local=False):
+    # world space points as a (n,3) array, object space if local, None if the raw buffer can't be read
+    try:
+        _pts = rawArray( mshfn.getRawPoints(), mshfn.numVertices() )
+    except Exception:
+        return None
+    if local:
+        return _pts
+    return transformPoints( _pts, worldMatrix(dag) )
+
+
+def bulkNormals(mshfn, dag, local=False):
+    # world space normals as a (n,3) array, object space if local, None if the raw buffer can't be read
+    try:
+        _n = rawArray( mshfn.getRawNormals(), mshfn.numNormals() )
+    except Exception:
+        return None
+    if local:
+        return _n
+    return transformNormals( _n, worldMatrix(dag) )
+
+
+def transformPoints(pts, m):
+    # (n,3) points through a 4x4 maya matrix
+    return numpy.dot(pts, m[:3,:3]) + m[3,:3]
+
+
+def transformNormals(n, m):
+    # (n,3) normals through the inverse transpose of a 4x4 maya matrix, normalized
+    n = numpy.dot( n, numpy.linalg.inv(m[:3,:3]).T )
+    l = numpy.sqrt( (n*n).sum(1) )
+    l[l==0] = 1
+    return n / l[:,None]
+
+
+
+# raw buffers of a shape, as read from maya (numpy arrays or lists):
+#   points, normals        flat world space xyz, object space for the shapes exported as instances
+#   counts                 vertex count of each face
+#   vertices, normalIds    vertex and normal index of each face-vertex
+#   uvCounts               uv count of each face (0 if unmapped)
+#   uvIds                  index in us/vs of each face-vertex of the mapped faces
+#   us, vs                 uv table
+#   colors                 flat rgba of each face-vertex (-1 if unset), None if colors aren't exported
+#   triangleCounts         triangle count of each face and the vertex indices of those triangles
+#   triangleVertices       (MFnMesh.getTriangles), only read when the shape has faces above 4 vertices
+
+def bulkBuffers(mshfn, dag, colors=False, local=False):
+    # raw buffers read at once through the api, None if a bulk call fails
+    _pts = bulkPoints(mshfn, dag, local)
+    _normals = bulkNormals(mshfn, dag, local)
+    if _pts is None or _normals is None:
+        return None
+
+    try:
+        _counts = om.MIntArray()
+        _vtx = om.MIntArray()
+        mshfn.getVertices(_counts, _vtx)
+
+        _npf = om.MIntArray()
+        _nid = om.MIntArray()
+        mshfn.getNormalIds(_npf, _nid)
+
+        _uvcounts = om.MIntArray()
+        _uvids = om.MIntArray()
+        mshfn.getAssignedUVs(_uvcounts, _uvids)
+
+        _u = om.MFloatArray()
+        _v = om.MFloatArray()
+        mshfn.getUVs(_u, _v)
+
+        _colors = None
+        if colors:
+            _colors = om.MColorArray()
+            mshfn.getFaceVertexColors(_colors)
+    except Exception:
+        return None
+
+    raw = {
+        'points': _pts.ravel(),
+        'normals': _normals.ravel(),
+        'counts': toArray(_counts, numpy.int64),
+        'vertices': toArray(_vtx, numpy.int64),
+        'normalIds': toArray(_nid, numpy.int64),
+        'uvCounts': toArray(_uvcounts, numpy.int64),
+        'uvIds': toArray(_uvids, numpy.int64),
+        'us': toArray(_u),
+        'vs': toArray(_v),
+        'colors': None,
+        }
+    if _colors is not None:
+        raw['colors'] = colorArray(_colors).ravel()
+
+    # maya's own triangulation of the n-gons, see splitPolygons
+    if (raw['counts'] > 4).any():
+        try:
+            _tricounts = om.MIntArray()
+            _trivtx = om.MIntArray()
+            mshfn.getTriangles(_tricounts, _trivtx)
+            raw['triangleCounts'] = toArray(_tricounts, numpy.int64)
+            raw['triangleVertices'] = toArray(_trivtx, numpy.int64)
+        except Exception:
+            pass
+    return raw
+
+
+def iterBuffers(mshfn, dag, colors=False, local=False):
+    # raw buffers read vertex by vertex and face by face, as lists
+
+    space = om.MSpace.kWorld
+    if local:
+        space = om.MSpace.kObject
+
+    _pts = om.MPointArray()
+    mshfn.getPoints(_pts, space)
+    points = []
+    for i in xrange(_pts.length()):
+        points += [ _pts[i][0], _pts[i][1], _pts[i][2] ]
+
+    _normals = om.MFloatVectorArray()
+    mshfn.getNormals(_normals, space)
+    normals = []
+    for i in xrange(_normals.length()):
+        normals += [ _normals[i][0], _normals[i][1], _normals[i][2] ]
+
+    _npf = om.MIntArray()
+    _nid = om.MIntArray()
+    mshfn.getNormalIds(_npf, _nid)
+
+    raw = {
+        'points': points,
+        'normals': normals,
+        'counts': [],
+        'vertices': [],
+        'normalIds': list(_nid),
+        'uvCounts': [],
+        'uvIds': [],
+        'us': [],
+        'vs': [],
+        'colors': None,
+        }
+    # colors of every face-vertex at once, (-1, -1, -1, -1) where unset
+    if colors:
+        _colors = om.MColorArray()
+        mshfn.getFaceVertexColors(_colors)
+        raw['colors'] = []
+        for i in xrange(_colors.length()):
+            c = _colors[i]
+            raw['colors'] += [ c.r, c.g, c.b, c.a ]
+
+    it = om.MItMeshPolygon(dag)
+    while not it.isDone():
+
+        _vtx = om.MIntArray()
+        it.getVertices( _vtx )
+        raw['counts'].append( len(_vtx) )
+        raw['vertices'] += list(_vtx)
+
+        _u = om.MFloatArray()
+        _v = om.MFloatArray()
+        try:
+            it.getUVs( _u, _v )
+            _n = len(raw['us'])
+            raw['uvCounts'].append( len(_u) )
+            raw['uvIds'] += range(_n, _n+len(_u))
+            raw['us'] += list(_u)
+            raw['vs'] += list(_v)
+        except:
+            raw['uvCounts'].append(0)
+
+        it.next()
+
+    if any( n > 4 for n in raw['counts'] ):
+        _tricounts = om.MIntArray()
+        _trivtx = om.MIntArray()
+        mshfn.getTriangles(_tricounts, _trivtx)
+        raw['triangleCounts'] = list(_tricounts)
+        raw['triangleVertices'] = list(_trivtx)
+
+    return raw
+
+
+
+def buildGeometry(raw):
+    # round, weld and encode the raw buffers of a shape with shape local indices
+    # polygons above 4 vertices are left out, they are split beforehand (see splitPolygons)
+    # doesn't touch maya so it can run in worker processes, see buildGeometries
+    if numpy is None:
+        return buildGeometryList(raw)
+
+    counts = numpy.asarray(raw['counts'], numpy.int64)
+    fvkeep = numpy.repeat(counts <= 4, counts)
+    vtx = numpy.asarray(raw['vertices'], numpy.int64)
+
+    geo = {
+        'name': raw['name'],
+        'vertices': roundArray( raw['points'], DECIMALS_VERTICES ),
+        'normals': roundArray( raw['normals'], DECIMALS_NORMALS ),
+        'uvs': [],
+        'colors': [],
+        'faceCount': int( (counts <= 4).sum() ),
+        }
+
+    # uvs are welded by (vertex, u, v) once rounded
+    # indices follow first occurrence so they are stable from one export to the other
+    fvuv = None
+    mapped = numpy.repeat( numpy.asarray(raw['uvCounts'], numpy.int64) > 0, counts )
+    if mapped.any():
+        uvids = numpy.asarray(raw['uvIds'], numpy.int64)[ fvkeep[mapped] ]
+        mapped &= fvkeep
+        ids, geo['uvs'] = weldUVs( vtx[mapped], numpy.asarray(raw['us'])[uvids], numpy.asarray(raw['vs'])[uvids] )
+        fvuv = numpy.empty(len(vtx), numpy.int64)
+        fvuv.fill(-1)
+        fvuv[mapped] = ids
+
+    # palette of the distinct colors, in order of first use, -1 picks the white default one
+    fvcolor = None
+    if raw['colors'] is not None:
+        rgb = numpy.asarray(raw['colors'], numpy.float64).reshape(-1, 4)
+        colored = ~(rgb == -1).all(1) & fvkeep
+        geo['colors'], ids = palette( packColors( rgb[colored] ) )
+        fvcolor = numpy.empty(len(rgb), numpy.int64)
+        fvcolor.fill(-1)
+        fvcolor[colored] = ids
+
+    mats = None
+    shaders = raw['shaders']
+    if len(shaders) == 1:
+        mats = shaders[0]
+    elif shaders:
+        mats = numpy.asarray(shaders)[ numpy.asarray(raw['faceShaders'], numpy.int64) ]
+
+    # normals are welded once rounded, numbered by first use
+    geo['normals'], normalIds = weldNormals( geo['normals'], numpy.asarray(raw['normalIds'], numpy.int64) )
+
+    if not raw.get('indexed'):
+        geo['faces'], geo['kinds'] = encodeFaces( counts, vtx, normalIds, mats, fvuv, fvcolor )
+        return geo
+
+    # per vertex attributes, taken from the face-vertex each vertex was split from
+    corners, geo['indices'], geo['groups'], geo['acmr'] = indexFaces( counts, vtx, normalIds, mats, fvuv, fvcolor )
+    fvkeep = numpy.flatnonzero(fvkeep)[corners]
+
+    geo['vertexIds'] = vtx[fvkeep]
+    geo['vertices'] = geo['vertices'].reshape(-1, 3)[ geo['vertexIds'] ].ravel()
+    geo['normals'] = geo['normals'].reshape(-1, 3)[ normalIds[fvkeep] ].ravel()
+    if fvuv is not None:
+        uvs = numpy.vstack( ( geo['uvs'].reshape(-1, 2), [(0.0, 0.0)] ) )
+        geo['uvs'] = uvs[ fvuv[fvkeep] ].ravel()
+    if fvcolor is not None:
+        colors = numpy.append( geo['colors'], 16777215 )
+        geo['colors'] = colors[ fvcolor[fvkeep] ]
+    geo['faceCount'] = len(geo['indices'])/3
+    return geo
+
+
+def buildGeometryList(raw):
+    # buildGeometry face by face on plain lists, when numpy isn't available
+
+    geo = {
+        'name': raw['name'],
+        'vertices': roundList( raw['points'], DECIMALS_VERTICES ),
+        'normals': [],
+        'uvs': [],
+        'colors': [],
+        'faces': [],
+        'kinds': [],
+        'faceCount': 0,
+        }
+
+    shaders = raw['shaders']
+    normals = roundList( raw['normals'], DECIMALS_NORMALS )
+    welded = {}
+    uvs = {}
+    colors = {}
+    _vfoffset = 0
+    _uvoffset = 0
+
+    for f,n in enumerate(raw['counts']):
+        _uvn = raw['uvCounts'][f]
+
+        if n > 4:
+            _vfoffset += n
+            _uvoffset += _uvn
+            continue
+
+        vtx = raw['vertices'][_vfoffset:_vfoffset+n]
+        dbf = [0] + vtx
+        kinds = [INDEX_NONE] + [INDEX_VERTEX]*n
+        if n == 4:
+            dbf[0] += FACE_QUAD
+
+        # material
+        if shaders:
+            dbf[0] += FACE_MATERIAL
+            dbf.append( shaders[ raw['faceShaders'][f] if len(shaders) > 1 else 0 ] )
+            kinds.append(INDEX_MATERIAL)
+
+        # uvs
+        if _uvn:
+            dbf[0] += FACE_VERTEX_UV
+            for v,i in zip( vtx, raw['uvIds'][_uvoffset:_uvoffset+n] ):
+                uv = roundList( (raw['us'][i], raw['vs'][i]), DECIMALS_UVS )
+                key = (v, uv[0], uv[1])
+
+                i = uvs.get(key)
+                if i is None:
+                    i = len(geo['uvs'])/2
+                    geo['uvs'] += uv
+                    uvs[key] = i
+                dbf.append(i)
+            kinds += [INDEX_UV]*n
+
+        # normals
+        dbf[0] += FACE_VERTEX_NORMAL
+        for i in raw['normalIds'][_vfoffset:_vfoffset+n]:
+            key = tuple( normals[i*3:i*3+3] )
+
+            i = welded.get(key)
+            if i is None:
+                i = len(geo['normals'])/3
+                geo['normals'] += key
+                welded[key] = i
+            dbf.append(i)
+        kinds += [INDEX_NORMAL]*n
+
+        # colors
+        if raw['colors'] is not None:
+            dbf[0] += FACE_VERTEX_COLOR
+            for i in xrange(_vfoffset, _vfoffset+n):
+                color = raw['colors'][i*4:i*4+4]
+                if color != [-1, -1, -1, -1]:
+                    c = (int(color[0]*255)<<16) + (int(color[1]*255)<<8) + int(color[2]*255)
+                    ci = colors.get(c)
+                    if ci is None:
+                        ci = len(geo['colors'])
+                        geo['colors'].append(c)
+                        colors[c] = ci
+                    dbf.append(ci)
+                    kinds.append(INDEX_COLOR)
+                else:
+                    # white for colorless vertex
+                    dbf.append(0)
+                    kinds.append(INDEX_NONE)
+
+        geo['faces'] += dbf
+        geo['kinds'] += kinds
+        geo['faceCount'] += 1
+        _vfoffset += n
+        _uvoffset += _uvn
+
+    return geo
+
+
+def decimate(raw, ratio, iterations=16, tolerance=LOD_TOLERANCE):
+    # raw buffers of a shape reduced to about `ratio` of its faces by vertex clustering
+    # vertices are grouped in grid cells, each group replaced by its member closest to the group center
+    # so uvs, normals, colors (and skin weights, see vertexIds) are those of an original vertex
+    # faces are split in charts along their uv, normal and material seams (see faceCharts). a vertex only merges
+    # with the vertices touching the same charts, so seam vertices collapse along their own seam, and each
+    # face-vertex moved takes the uv and normal its representative has in the face chart
+    # colors aren't seams: a face-vertex moved takes the color of its representative when that one has a single
+    # color in the chart, else keeps its own, so per face colors are kept
+    # when the charts keep the shape further than tolerance from the target, vertices merge across charts,
+    # the face-vertices moved out of their chart keeping their own attributes
+    # vertices on borders, or with several uvs or normals in one chart, are never moved, nor merged with
+    # vertices of another material or facing another way
+    # the cell size is searched by dichotomy, returns the original index of the vertices kept and the raw buffers
+    counts = numpy.asarray(raw['counts'], numpy.int64)
+    vtx = numpy.asarray(raw['vertices'], numpy.int64)
+    normalIds = numpy.asarray(raw['normalIds'], numpy.int64)
+    points = numpy.asarray(raw['points'], numpy.float64).reshape(-1, 3)
+    normals = numpy.asarray(raw['normals'], numpy.float64).reshape(-1, 3)
+    nv = len(points)
+
+    # polygons above 4 vertices are split beforehand, see buildShape
+    keep = counts <= 4
+    fvkeep = numpy.repeat(keep, counts)
+    fvface = numpy.repeat( numpy.arange(len(counts)), counts )[fvkeep]
+    vtx, normalIds = vtx[fvkeep], normalIds[fvkeep]
+    n4 = counts[keep]
+
+    # per face-vertex uv (-1 if unmapped), color row and material slot
+    uvCounts = numpy.asarray(raw['uvCounts'], numpy.int64)
+    mapped = numpy.repeat(uvCounts > 0, counts)
+    fvuv = numpy.empty(len(mapped), numpy.int64)
+    fvuv.fill(-1)
+    fvuv[mapped] = raw['uvIds']
+    fvuv = fvuv[fvkeep]
+    us = roundArray( raw['us'], DECIMALS_UVS )
+    vs = roundArray( raw['vs'], DECIMALS_UVS )
+
+    fvcolor = numpy.flatnonzero(fvkeep)
+    fvslot = numpy.zeros(len(vtx), numpy.int64)
+    if raw['faceShaders'] is not None:
+        fvslot = numpy.asarray(raw['faceShaders'], numpy.int64)[fvface]
+
+    # wedge: normal, uv and material of a face-vertex, charts are the faces joined by edges without wedge change
+    columns = numpy.column_stack( [ normalIds, numpy.where(fvuv >= 0, us[fvuv], -1e9),
+                                    numpy.where(fvuv >= 0, vs[fvuv], -1e9), fvslot ] )
+    wedges = numpy.unique(columns, return_inverse=True, axis=0)[1] if len(vtx) else numpy.zeros(0, numpy.int64)
+    charts = faceCharts(n4, vtx, wedges)
+    nc = charts.max() + 1 if len(charts) else 1
+    fvchart = charts[ numpy.repeat( numpy.arange(len(n4)), n4 ) ]
+
+    # (vertex, chart) pairs: the face-vertices of a vertex in a chart must share their wedge
+    pair = vtx * nc + fvchart
+    pairs, fvpair = numpy.unique(pair, return_inverse=True)
+    pairVertex = pairs // nc
+
+    locked = numpy.zeros(nv, bool)
+    locked[ pairVertex[ seamVertices(fvpair, wedges, len(pairs)) ] ] = True
+    locked[ borderVertices(n4, vtx) ] = True
+    locked[ numpy.bincount(vtx, minlength=nv) == 0 ] = True
+
+    # a single color per (vertex, chart), or none
+    uniform = numpy.zeros(len(pairs), bool)
+    if raw['colors'] is not None:
+        rgba = numpy.asarray(raw['colors'], numpy.float64).reshape(-1, 4)[fvcolor]
+        uniform[:] = True
+        for k in xrange(4):
+            uniform &= ~seamVertices(fvpair, rgba[:,k], len(pairs))
+
+    # charts touched by each vertex, as an id shared by the vertices touching the same ones
+    order = numpy.lexsort( (pairs % nc, pairVertex) )
+    rank = numpy.arange(len(pairs)) - numpy.searchsorted( pairVertex[order], pairVertex[order] )
+    touched = -numpy.ones( (nv, rank.max() + 1 if len(rank) else 1), numpy.int64 )
+    touched[ pairVertex[order], rank ] = pairs[order] % nc
+    signature = numpy.unique(touched, return_inverse=True, axis=0)[1]
+
+    # never merged: different materials, mapped or not, normals along different axes
+    n = normals[normalIds]
+    major = numpy.abs(n).argmax(1)
+    group = numpy.zeros(nv, numpy.int64)
+    group[vtx] = ( ( fvslot * 2 + (fvuv >= 0) ) * 3 + major ) * 2 + ( n[ numpy.arange(len(vtx)), major ] < 0 )
+    group = numpy.unique(group, return_inverse=True)[1]
+
+    lo = points.min(0) if nv else numpy.zeros(3)
+    size = max( (points.max(0) - lo).max() if nv else 0.0, 1e-9 )
+    target = ratio * len(n4)
+
+    def search(group):
+        best = None
+        a, b = 0.0, size
+        for i in xrange(iterations):
+            h = (a + b) / 2
+            result = clusterFaces(points, vtx, n4, locked, group, lo, h)
+            faces = len(result[2])
+            if best is None or abs(faces - target) < abs(best[0] - target):
+                best = (faces, h, result)
+            if faces > target:
+                a = h
+            else:
+                b = h
+            if abs(faces - target) <= 0.01 * target:
+                break
+        return best
+
+    best = search( numpy.unique( group * (signature.max() + 1) + signature, return_inverse=True )[1] )
+    if best[0] > target * (1 + tolerance):
+        best = search(group)
+
+    rep, fvkept, newcounts = best[2]
+
+    # attributes of the face-vertices moved: their representative's ones in the same chart
+    # the color only if it has a single one there, the face-vertex own ones out of the chart
+    rv = rep[vtx]
+    moved = numpy.flatnonzero(rv != vtx)
+    byPair = numpy.empty(len(pairs), numpy.int64)
+    byPair[fvpair] = numpy.arange(len(vtx))
+    at = numpy.minimum( numpy.searchsorted(pairs, rv[moved] * nc + fvchart[moved]), max(len(pairs) - 1, 0) )
+    found = pairs[at] == rv[moved] * nc + fvchart[moved]
+    moved, at = moved[found], at[found]
+    src = numpy.arange(len(vtx))
+    src[moved] = byPair[at]
+    normalIds = normalIds[src][fvkept]
+    fvuv = fvuv[src][fvkept]
+    colored = moved[ uniform[at] ]
+    fvcolor = fvcolor.copy()
+    fvcolor[colored] = fvcolor[ src[colored] ]
+    fvcolor = fvcolor[fvkept]
+    rv = rv[fvkept]
+
+    # compact the vertices and normals left
+    vertexIds, rv = numpy.unique(rv, return_inverse=True)
+    normalKept, normalIds = numpy.unique(normalIds, return_inverse=True)
+
+    faces = numpy.unique(fvface[fvkept])
+    faceMapped = uvCounts[faces] > 0
+    fvmapped = numpy.repeat(faceMapped, newcounts)
+
+    lod = {
+        'name': raw['name'],
+        'shaders': raw['shaders'],
+        'faceShaders': None,
+        'points': points[vertexIds].ravel(),
+        'normals': normals[normalKept].ravel(),
+        'counts': newcounts,
+        'vertices': rv,
+        'normalIds': normalIds,
+        'uvCounts': numpy.where(faceMapped, newcounts, 0),
+        'uvIds': fvuv[fvmapped],
+        'us': raw['us'],
+        'vs': raw['vs'],
+        'colors': None,
+        }
+    if raw['faceShaders'] is not None:
+        lod['faceShaders'] = numpy.asarray(raw['faceShaders'], numpy.int64)[faces]
+    if raw['colors'] is not None:
+        lod['colors'] = numpy.asarray(raw['colors'], numpy.float64).reshape(-1, 4)[fvcolor].ravel()
+
+    return vertexIds, lod
+
+
+def faceCharts(counts, vtx, wedges):
+    # chart of each face: faces sharing an edge whose two ends have the same wedge in both faces are in the same chart
+    # components are found by hooking the larger chart of each such edge onto the smaller one, then path halving
+    nf = len(counts)
+    start = numpy.cumsum(counts) - counts
+    fvface = numpy.repeat( numpy.arange(nf), counts )
+    corner = numpy.arange(len(vtx)) - start[fvface]
+    nxt = start[fvface] + (corner + 1) % counts[fvface]
+
+    # each edge of a face as (lower vertex, upper vertex, wedge at lower, wedge at upper)
+    a, b = vtx, vtx[nxt]
+    wa, wb = wedges, wedges[nxt]
+    swap = a > b
+    edges = numpy.column_stack( ( numpy.where(swap, b, a), numpy.where(swap, a, b),
+                                  numpy.where(swap, wb, wa), numpy.where(swap, wa, wb) ) )
+    order = numpy.lexsort( edges.T[::-1] )
+    same = ( edges[order][1:] == edges[order][:-1] ).all(1)
+    fa, fb = fvface[order][:-1][same], fvface[order][1:][same]
+
+    label = numpy.arange(nf)
+    while len(fa):
+        la, lb = label[fa], label[fb]
+        split = la != lb
+        fa, fb, la, lb = fa[split], fb[split], la[split], lb[split]
+        if not len(fa):
+            break
+        hi, low = numpy.maximum(la, lb), numpy.minimum(la, lb)
+        order = numpy.lexsort( (low, hi) )
+        first = numpy.ones(len(hi), bool)
+        first[1:] = hi[order][1:] != hi[order][:-1]
+        label[ hi[order][first] ] = numpy.minimum( label[ hi[order][first] ], low[order][first] )
+        while True:
+            jumped = label[label]
+            if (jumped == label).all():
+                break
+            label = jumped
+    return numpy.unique(label, return_inverse=True)[1]
+
+
+def clusterFaces(points, vtx, counts, locked, group, lo, h):
+    # vertex clustering at cell size h, see decimate
+    # returns the representative of each vertex, the face-vertices kept and the vertex count of the faces kept
+    nv = len(points)
+    cell = numpy.floor( (points - lo) / h ).astype(numpy.int64)
+    cell -= cell.min(0)
+    dims = cell.max(0) + 1
+    cell = numpy.unique( ( cell[:,0] * dims[1] + cell[:,1] ) * dims[2] + cell[:,2], return_inverse=True )[1]
+    key = group * (cell.max() + 1 if nv else 1) + cell
+    key = numpy.where( locked, -1 - numpy.arange(nv), key )
+    ids, cluster = numpy.unique(key, return_inverse=True)
+
+    # member closest to the center of its cluster
+    center = numpy.column_stack( [ numpy.bincount(cluster, points[:,k], len(ids)) for k in xrange(3) ] )
+    center /= numpy.bincount(cluster, minlength=len(ids))[:,None]
+    d = ( (points - center[cluster])**2 ).sum(1)
+    order = numpy.lexsort( (d, cluster) )
+    first = numpy.ones(nv, bool)
+    first[1:] = cluster[order][1:] != cluster[order][:-1]
+    rep = numpy.empty(len(ids), numpy.int64)
+    rep[ cluster[order][first] ] = order[first]
+    rep = rep[cluster]
+
+    # drop the corners merged with the next one, then the faces left with less than 3 corners
+    # or folded (opposite corners of a quad merged)
+    rv = rep[vtx]
+    start = numpy.cumsum(counts) - counts
+    fvface = numpy.repeat( numpy.arange(len(counts)), counts )
+    corner = numpy.arange(len(vtx)) - start[fvface]
+    nxt = start[fvface] + (corner + 1) % counts[fvface]
+    single = rv != rv[nxt]
+
+    newcounts = numpy.bincount(fvface, single, len(counts)).astype(numpy.int64)
+    quads = start[counts == 4]
+    folded = numpy.zeros(len(counts), bool)
+    folded[counts == 4] = (rv[quads] == rv[quads+2]) | (rv[quads+1] == rv[quads+3])
+    good = (newcounts >= 3) & ~folded
+
+    fvkept = single & good[fvface]
+    return rep, fvkept, newcounts[good]
+
+
+def seamVertices(vtx, values, nv):
+    # vertices whose face-vertices don't all have the same value
+    order = numpy.lexsort( (values, vtx) )
+    _v, _x = vtx[order], values[order]
+    change = (_v[1:] == _v[:-1]) & (_x[1:] != _x[:-1])
+    seam = numpy.zeros(nv, bool)
+    seam[ _v[1:][change] ] = True
+    return seam
+
+
+def borderVertices(counts, vtx):
+    # vertices of the edges used by a single face
+    start = numpy.cumsum(counts) - counts
+    fvface = numpy.repeat( numpy.arange(len(counts)), counts )
+    corner = numpy.arange(len(vtx)) - start[fvface]
+    nxt = vtx[ start[fvface] + (corner + 1) % counts[fvface] ]
+    a, b = numpy.minimum(vtx, nxt), numpy.maximum(vtx, nxt)
+    edges, inverse, uses = numpy.unique( a * (vtx.max()+1 if len(vtx) else 1) + b, return_inverse=True, return_counts=True )
+    border = uses[inverse] == 1
+    return numpy.unique( numpy.concatenate( (a[border], b[border]) ) )
+
+
+def buildShape(raw):
+    # buildGeometry of a shape, then of each of its levels of detail in geo['lods'] (see decimate)
+    # raw['lods']: face ratio of each level, each level geo gets the vertexIds it kept
+    # n-gons are split in triangles first
+    raw = splitPolygons(raw)
+    geo = buildGeometry(raw)
+    geo['lods'] = []
+    for ratio in raw.get('lods', ()):
+        vertexIds, lod = decimate(raw, ratio)
+        lod['indexed'] = raw.get('indexed')
+        lod = buildGeometry(lod)
+        if 'vertexIds' in lod:
+            vertexIds = vertexIds[ lod['vertexIds'] ]
+        lod['vertexIds'] = vertexIds
+        geo['lods'].append(lod)
+    return geo
+
+
+def splitPolygons(raw):
+    # raw buffers with the faces above 4 vertices replaced by their triangles, in place of the polygon
+    # triangles are maya's (raw['triangleCounts'] and raw['triangleVertices']) when read, else fans
+    # each triangle corner keeps the normal, uv and color of the polygon face-vertex it comes from
+    if numpy is None:
+        if not any( n > 4 for n in raw['counts'] ):
+            return raw
+        return splitPolygonsList(raw)
+
+    counts = numpy.asarray(raw['counts'], numpy.int64)
+    big = counts > 4
+    if not big.any():
+        return raw
+
+    vtx = numpy.asarray(raw['vertices'], numpy.int64)
+    first = numpy.cumsum(counts) - counts
+    fvface = numpy.repeat( numpy.arange(len(counts)), counts )
+
+    # triangles of the polygons as face-vertex indices, maya's ones are matched by (face, vertex)
+    corners = None
+    if raw.get('triangleCounts') is not None:
+        tc = numpy.asarray(raw['triangleCounts'], numpy.int64)
+        trface = numpy.repeat( numpy.arange(len(counts)), tc )
+        trbig = big[trface]
+        trface = trface[trbig]
+        tv = numpy.asarray(raw['triangleVertices'], numpy.int64).reshape(-1, 3)[trbig]
+
+        nv = max( vtx.max(), tv.max() ) + 1 if len(tv) else 1
+        keys = fvface * nv + vtx
+        order = numpy.argsort(keys, kind='mergesort')
+        _keys = keys[order]
+        wanted = trface[:,None] * nv + tv
+        pos = numpy.minimum( numpy.searchsorted(_keys, wanted), len(_keys)-1 )
+        if (_keys[pos] == wanted).all() and ( tc[big] > 0 ).all():
+            corners = order[pos]
+
+    if corners is None:
+        tn = counts[big] - 2
+        trface = numpy.repeat( numpy.flatnonzero(big), tn )
+        k = numpy.arange(len(trface)) - (numpy.cumsum(tn) - tn)[ numpy.repeat(numpy.arange(len(tn)), tn) ]
+        f = first[trface]
+        corners = numpy.column_stack( (f, f + k + 1, f + k + 2) )
+
+    # polygons are replaced where they were: faces and face-vertices stably sorted by original face
+    small = ~big
+    fvsmall = numpy.flatnonzero( small[fvface] )
+    face = numpy.concatenate( (numpy.flatnonzero(small), trface) )
+    faceOrder = numpy.argsort(face, kind='mergesort')
+    fvOrder = numpy.argsort( numpy.concatenate( (fvface[fvsmall], numpy.repeat(trface, 3)) ), kind='mergesort' )
+
+    face = face[faceOrder]
+    newcounts = numpy.concatenate( (counts[small], numpy.repeat(3, len(trface))) )[faceOrder]
+    fv = numpy.concatenate( (fvsmall, corners.ravel()) )[fvOrder]
+
+    uvCounts = numpy.asarray(raw['uvCounts'], numpy.int64)
+    mapped = numpy.repeat(uvCounts > 0, counts)
+    fvuv = numpy.zeros(len(vtx), numpy.int64)
+    fvuv[mapped] = raw['uvIds']
+    newmapped = uvCounts[face] > 0
+
+    raw = dict(raw)
+    raw.pop('triangleCounts', None)
+    raw.pop('triangleVertices', None)
+    raw.update( {
+        'counts': newcounts,
+        'vertices': vtx[fv],
+        'normalIds': numpy.asarray(raw['normalIds'], numpy.int64)[fv],
+        'uvCounts': numpy.where(newmapped, newcounts, 0),
+        'uvIds': fvuv[fv][ numpy.repeat(newmapped, newcounts) ],
+        } )
+    if raw['colors'] is not None:
+        raw['colors'] = numpy.asarray(raw['colors'], numpy.float64).reshape(-1, 4)[fv].ravel()
+    if raw['faceShaders'] is not None:
+        raw['faceShaders'] = numpy.asarray(raw['faceShaders'], numpy.int64)[face]
+    return raw
+
+
+def splitPolygonsList(raw):
+    # splitPolygons face by face on plain lists, when numpy isn't available
+    tc = raw.get('triangleCounts')
+    tv = raw.get('triangleVertices')
+
+    out = dict(raw)
+    out.pop('triangleCounts', None)
+    out.pop('triangleVertices', None)
+    for k in ('counts', 'vertices', 'normalIds', 'uvCounts', 'uvIds'):
+        out[k] = []
+    if raw['colors'] is not None:
+        out['colors'] = []
+    if raw['faceShaders'] is not None:
+        out['faceShaders'] = []
+
+    _vfoffset = 0
+    _uvoffset = 0
+    _troffset = 0
+
+    for f,n in enumerate(raw['counts']):
+        _uvn = raw['uvCounts'][f]
+        _trn = tc[f] if tc is not None else 0
+
+        corners = [ range(n) ]
+        if n > 4:
+            # corners of maya's triangles, fans if a vertex can't be found in the polygon
+            vtx = list( raw['vertices'][_vfoffset:_vfoffset+n] )
+            triangles = tv[_troffset*3:(_troffset+_trn)*3] if tc is not None else []
+            if _trn and all( v in vtx for v in triangles ):
+                corners = [ [ vtx.index(v) for v in triangles[i:i+3] ] for i in xrange(0, len(triangles), 3) ]
+            else:
+                corners = [ [0, i+1, i+2] for i in xrange(n-2) ]
+
+        for c in corners:
+            out['counts'].append( len(c) )
+            out['vertices'] += [ raw['vertices'][_vfoffset+i] for i in c ]
+            out['normalIds'] += [ raw['normalIds'][_vfoffset+i] for i in c ]
+            out['uvCounts'].append( len(c) if _uvn else 0 )
+            if _uvn:
+                out['uvIds'] += [ raw['uvIds'][_uvoffset+i] for i in c ]
+            if raw['colors'] is not None:
+                for i in c:
+                    out['colors'] += raw['colors'][(_vfoffset+i)*4:(_vfoffset+i)*4+4]
+            if raw['faceShaders'] is not None:
+                out['faceShaders'].append( raw['faceShaders'][f] )
+
+        _vfoffset += n
+        _uvoffset += _uvn
+        _troffset += _trn
+
+    return out
+
+
+def reportedBuild(raw):
+    # buildShape timed from inside the worker, the Report record is stored in geo['report']
+    wall, cpu = time.time(), cpuTime()
+    geo = buildShape(raw)
+    geo['report'] = {
+        'stage': 'build',
+        'mesh': raw['name'],
+        'count': geo['faceCount'],
+        'wall': time.time() - wall,
+        'cpu': cpuTime() - cpu,
+        'worker': os.getpid(),
+        }
+    return geo
+
+
+def buildGeometries(raws, workers=1):
+    # buildGeometry over many shapes in a pool of processes, results come back in the same order
+    # each geo gets the Report record of its build in 'report'
+    # workers: number of processes, 0 for one per cpu
+    if workers == 1 or len(raws) < 2:
+        return map(reportedBuild, raws)
+
+    pool = multiprocessing.Pool(workers or None)
+    try:
+        geos = pool.map(reportedBuild, raws, 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return geos
+
+
+def geometryBuffers(indexed=False):
+    # empty per shape buffers of a db, see appendGeometry
+    if indexed:
+        return {
+            'vertices': [],
+            'indices': [],
+            'groups': [],
+            'uvs': [],
+            'normals': [],
+            'colors': [],
+            }
+
+    white = [16777215] #white for colorless
+    if numpy is not None:
+        white = numpy.asarray(white, numpy.int64)
+    palettes = { 'colors': Palette(), 'normals': Palette() }
+    palettes['colors'].add(white)
+
+    return {
+        'vertices': [],
+        'faces': [],
+        'uvs': [],
+        'normals': [],
+        'colors': [ white ],
+        'palettes': palettes,
+        }
+
+
+def appendGeometry(geo, materials, md, buffers):
+    # append a built shape to per shape buffers, its indices shifted after the counts of metadata md
+    # materials: db material of each of the shape slots. returns the shape vertex count
+    _v = len(geo['vertices'])/3
+
+    if 'indices' in geo:
+        # indexed shapes: uvs and colors are per vertex, unmapped and colorless shapes are padded
+        # md counts the mapped and colored vertices, see finishBuffers
+        buffers['uvs'].append( geo['uvs'] if len(geo['uvs']) else numpy.zeros(_v*2) )
+        buffers['colors'].append( geo['colors'] if len(geo['colors']) else numpy.repeat(16777215, _v) )
+        buffers['indices'].append( geo['indices'] + md['vertices'] )
+        md['colors'] += len(geo['colors'])
+
+        start = md['faces'] * 3
+        for slot, _start, count in geo['groups']:
+            material = None if slot is None else materials[slot]
+            last = buffers['groups'][-1] if buffers['groups'] else None
+            if last and last['materialIndex'] == material and last['start'] + last['count'] == start + _start:
+                last['count'] += count
+            else:
+                buffers['groups'].append( { 'start': start + _start, 'count': count, 'materialIndex': material } )
+
+        buffers['normals'].append( geo['normals'] )
+        md['normals'] += len(geo['normals'])/3
+
+    else:
+        # colors and normals go to the palettes shared by all shapes, white included
+        # only the values no previous shape had are appended
+        palettes = buffers['palettes']
+        offsets = [ 0, md['vertices'], md['uvs'], 0, 0, 0 ]
+        buffers['uvs'].append( geo['uvs'] )
+
+        colors, new = palettes['colors'].add( geo['colors'] )
+        buffers['colors'].append( pickRows(geo['colors'], new) )
+        normals, new = palettes['normals'].add( normalKeys(geo['normals']) )
+        buffers['normals'].append( pickRows(geo['normals'], new, 3) )
+
+        faces = shiftIndices(geo['faces'], geo['kinds'], offsets)
+        faces = remapIndices(faces, geo['kinds'], INDEX_COLOR, colors)
+        faces = remapIndices(faces, geo['kinds'], INDEX_NORMAL, normals)
+        buffers['faces'].append( remapIndices(faces, geo['kinds'], INDEX_MATERIAL, materials) )
+        md['colors'] = palettes['colors'].count
+        md['normals'] = palettes['normals'].count
+
+    buffers['vertices'].append( geo['vertices'] )
+
+    md['vertices'] += _v
+    md['uvs'] += len(geo['uvs'])/2
+    md['faces'] += geo['faceCount']
+    return _v
+
+
+def normalKeys(normals, decimals=DECIMALS_NORMALS):
+    # one hashable key per normal of a flat xyz buffer, equal for normals equal once rounded
+    # arrays: int64 of the three rounded components packed in base 2*10**decimals+1, lists: xyz tuples
+    if not isArray(normals):
+        return [ tuple(normals[i:i+3]) for i in xrange(0, len(normals), 3) ]
+
+    q = numpy.round( numpy.asarray(normals, numpy.float64).reshape(-1, 3) * 10**decimals ).astype(numpy.int64)
+    q = numpy.clip( q + 10**decimals, 0, 2*10**decimals )
+    base = 2*10**decimals + 1
+    return ( q[:,0]*base + q[:,1] )*base + q[:,2]
+
+
+def weldNormals(normals, normalIds):
+    # distinct rounded normals of a flat buffer in order of first use by normalIds, and the new normal index of each face-vertex
+    welded, ids = palette( normalKeys(normals)[normalIds] )
+    rows = numpy.empty( (len(welded), 3) )
+    rows[ids] = normals.reshape(-1, 3)[normalIds]
+    return rows.ravel(), ids
+
+
+def geometryRanges(meshes, vertices, faces):
+    # name, first vertex and vertex count, first face and face count of each shape of a db
+    # faces are triangles of the indexed layout, 3 indices each
+    ranges = []
+    _v = _f = 0
+    for msh, nv, nf in zip(meshes, vertices, faces):
+        ranges.append( { 'name': str(msh), 'vertices': [_v, nv], 'faces': [_f, nf] } )
+        _v += nv
+        _f += nf
+    return ranges
+
+
+def palette(colors):
+    # distinct values of colors in order of first use, and the index of each color in them
+    values, first, ids = numpy.unique(colors, return_index=True, return_inverse=True)
+    byuse = numpy.argsort(first, kind='mergesort')
+    rank = numpy.empty(len(byuse), numpy.int64)
+    rank[byuse] = numpy.arange(len(byuse))
+    return values[byuse], rank[ids]
+
+
+def pickRows(values, new, width=1):
+    # rows of a flat buffer flagged in new, see Palette.add
+    if isArray(values):
+        return values.reshape(-1, width)[new].ravel()
+    return [ x for i,x in enumerate(values) if new[i/width] ]
+
+
+def finishBuffers(db, buffers):
+    # join the per shape buffers into db
+    # indexed layout: padded uvs and colors are dropped if no shape had any, else every vertex has one
+    groups = buffers.pop('groups', None)
+    buffers.pop('palettes', None)
+
+    for k,b in buffers.items():
+        db[k] = joinBuffers(b)
+
+    md = db['metadata']
+    if groups is not None:
+        db['groups'] = groups
+        for k in ('uvs', 'colors'):
+            if md[k]:
+                md[k] = md['vertices']
+            else:
+                db[k] = []
+
+    db['uvs'] = [ db['uvs'] ]
+
+
+def indexFaces(counts, vtx, normals, mats=None, uvs=None, colors=None, cache=VERTEX_CACHE):
+    # single index layout of a shape, polygons above 4 vertices are left out
+    # face-vertices sharing their vertex, normal, uv and color become one vertex, quads are split in two triangles
+    # triangles are grouped by material, each group ordered for the vertex cache (see tipsify),
+    # then vertices are numbered by first use so they are read in order too
+    # arguments are those of encodeFaces. returns the kept face-vertex each vertex is taken from, the triangles,
+    # the (material, start, count) groups in the triangles indices and the acmr before and after (see cacheMissRatio)
+    keep = counts <= 4
+    fvkeep = numpy.repeat(keep, counts)
+    n = counts[keep]
+
+    columns = [ vtx[fvkeep], normals[fvkeep] ]
+    if uvs is not None:
+        columns.append( uvs[fvkeep] )
+    if colors is not None:
+        columns.append( colors[fvkeep] )
+
+    # unique over the attribute columns, lexsort is stable: each vertex comes from its first face-vertex
+    order = numpy.lexsort( columns[::-1] )
+    start = numpy.zeros(len(order), bool)
+    start[:1] = True
+    for c in columns:
+        c = c[order]
+        start[1:] |= c[1:] != c[:-1]
+    fvids = numpy.empty(len(order), numpy.int64)
+    fvids[order] = numpy.cumsum(start) - 1
+    corners = order[start]
+
+    # fan triangles (0, k+1, k+2) of each face
+    tn = numpy.maximum(n - 2, 0)
+    trface = numpy.repeat( numpy.arange(len(n)), tn )
+    k = numpy.arange(len(trface)) - (numpy.cumsum(tn) - tn)[trface]
+    first = (numpy.cumsum(n) - n)[trface]
+    triangles = fvids[ numpy.column_stack( (first, first + k + 1, first + k + 2) ) ]
+
+    before = cacheMissRatio(triangles, cache)
+
+    # material groups, in the order materials are first met
+    if mats is None or not numpy.ndim(mats):
+        slots = numpy.zeros(len(trface), numpy.int64)
+        materials = [mats]
+    else:
+        materials, slots = numpy.unique( numpy.asarray(mats)[keep][trface], return_inverse=True )
+        rank = numpy.argsort( numpy.unique(slots, return_index=True)[1], kind='mergesort' )
+        materials = materials[rank].tolist()
+        slots = numpy.argsort(rank)[slots]
+
+    ordered = []
+    groups = []
+    _start = 0
+    for slot, material in enumerate(materials):
+        group = numpy.flatnonzero(slots == slot)
+        tris = triangles[group]
+        ids, local = numpy.unique(tris, return_inverse=True)
+        ordered.append( group[ tipsify( local.reshape(-1, 3), len(ids), cache ) ] )
+        groups.append( (material, _start, len(group)*3) )
+        _start += len(group)*3
+
+    triangles = triangles[ numpy.concatenate(ordered) ].ravel() if ordered else triangles.ravel()
+
+    # vertices numbered by first use
+    used, firstUse = numpy.unique(triangles, return_index=True)
+    byuse = numpy.argsort(firstUse, kind='mergesort')
+    rank = numpy.empty(len(byuse), numpy.int64)
+    rank[byuse] = numpy.arange(len(byuse))
+    triangles = rank[triangles]
+    corners = corners[ used[byuse] ]
+
+    after = cacheMissRatio( triangles.reshape(-1, 3), cache )
+    return corners, triangles, groups, (before, after)
+
+
+def tipsify(triangles, count, cache=VERTEX_CACHE):
+    # order of the triangles for a fifo vertex cache of `cache` entries (Sander, Nehab, Barczak, 2007)
+    # emits every triangle around a fanning vertex, then fans around the vertex of the last triangles
+    # that stays in cache the longest, or the last vertex left with triangles on dead ends
+    # triangles: (n, 3) vertex indices below count. linear in the number of triangles
+    if not len(triangles):
+        return numpy.zeros(0, numpy.int64)
+
+    flat = triangles.ravel()
+    live = numpy.bincount(flat, minlength=count)
+    offsets = numpy.concatenate( ([0], numpy.cumsum(live)) ).tolist()
+    adjacency = ( numpy.argsort(flat, kind='mergesort') // 3 ).tolist()
+    live = live.tolist()
+    flat = flat.tolist()
+
+    stamps = [0] * count
+    emitted = [False] * len(triangles)
+    order = []
+    deadEnd = []
+    clock = cache + 1
+    cursor = 0
+    f = flat[0]
+
+    while f >= 0:
+        candidates = []
+        for t in adjacency[ offsets[f]:offsets[f+1] ]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            order.append(t)
+            for v in flat[3*t:3*t+3]:
+                deadEnd.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if clock - stamps[v] > cache:
+                    stamps[v] = clock
+                    clock += 1
+
+        # the candidate with triangles left that is still cached once they are emitted, the oldest first
+        f = -1
+        best = -1
+        for v in candidates:
+            if live[v]:
+                p = 0
+                if clock - stamps[v] + 2*live[v] <= cache:
+                    p = clock - stamps[v]
+                if p > best:
+                    best = p
+                    f = v
+
+        if f < 0:
+            while deadEnd:
+                v = deadEnd.pop()
+                if live[v]:
+                    f = v
+                    break
+            else:
+                while cursor < count:
+                    if live[cursor]:
+                        f = cursor
+                        break
+                    cursor += 1
+
+    return numpy.asarray(order, numpy.int64)
+
+
+def cacheMissRatio(triangles, cache=VERTEX_CACHE):
+    # average cache miss ratio: vertices transformed per triangle drawn through a fifo cache of `cache` entries
+    # 3 when nothing is reused, 0.5 at best on big regular meshes
+    if not len(triangles):
+        return 0.0
+
+    flat = numpy.asarray(triangles).ravel()
+    stamps = [-cache] * ( int(flat.max()) + 1 )
+    misses = 0
+    for v in flat.tolist():
+        if misses - stamps[v] >= cache:
+            stamps[v] = misses
+            misses += 1
+    return misses * 3.0 / len(flat)
+
+
+def splitIndices(vertexIds, indices):
+    # indices of the vertices split from the given scene vertices, see indexFaces
+    # returns them with the position in indices each one comes from
+    order = numpy.argsort(vertexIds, kind='mergesort')
+    sortedIds = vertexIds[order]
+    lo = numpy.searchsorted(sortedIds, indices, 'left')
+    hi = numpy.searchsorted(sortedIds, indices, 'right')
+
+    picked = numpy.repeat( numpy.arange(len(indices)), hi - lo )
+    offset = numpy.arange(len(picked)) - numpy.repeat( numpy.cumsum(hi - lo) - (hi - lo), hi - lo )
+    return order[ lo[picked] + offset ], picked
+
+
+def shiftIndices(faces, kinds, offsets):
+    # add to each face stream entry the offset of the buffer it points to, offsets given by INDEX_* kinds
+    if numpy is not None and isinstance(faces, numpy.ndarray):
+        return faces + numpy.asarray(offsets, numpy.int64)[kinds]
+    return [ f + offsets[k] for f,k in zip(faces, kinds) ]
+
+
+def remapIndices(faces, kinds, kind, table):
+    # replace the face stream entries of the given INDEX_* kind by their value in table
+    if numpy is not None and isinstance(faces, numpy.ndarray):
+        faces = faces.copy()
+        _m = kinds == kind
+        if _m.any():
+            faces[_m] = numpy.asarray(table, numpy.int64)[ faces[_m] ]
+        return faces
+    return [ table[f] if k == kind else f for f,k in zip(faces, kinds) ]
+
+
+def weldUVs(vtx, us, vs, decimals=DECIMALS_UVS):
+    # vectorized unique over (vertex, u, v) triplets once uvs are rounded
+    # indices are given by first occurrence, the same as a dict filled face-vertex after face-vertex
+    us = roundArray(us, decimals)
+    vs = roundArray(vs, decimals)
+
+    order = numpy.lexsort((vs, us, vtx))
+    _vtx, _us, _vs = vtx[order], us[order], vs[order]
+
+    start = numpy.ones(len(order), bool)
+    start[1:] = (_vtx[1:] != _vtx[:-1]) | (_us[1:] != _us[:-1]) | (_vs[1:] != _vs[:-1])
+    group = numpy.cumsum(start) - 1
+
+    # lexsort is stable: the first element of each group is its first occurrence
+    first = order[start]
+    byfirst = numpy.argsort(first, kind='mergesort')
+    rank = numpy.empty(len(first), numpy.int64)
+    rank[byfirst] = numpy.arange(len(first))
+
+    ids = numpy.empty(len(order), numpy.int64)
+    ids[order] = rank[group]
+
+    first = first[byfirst]
+    uvs = numpy.empty(len(first)*2)
+    uvs[0::2] = us[first]
+    uvs[1::2] = vs[first]
+    return ids, uvs
+
+
+def connectedShaders(mshfn, dag):
+    # shading groups of the mesh instance and, for each face, its index in that list
+    # unassigned faces get the first one. returns None, None if the api call fails
+    try:
+        _sgs = om.MObjectArray()
+        _ids = om.MIntArray()
+        mshfn.getConnectedShaders( dag.instanceNumber(), _sgs, _ids )
+    except Exception:
+        return None, None
+
+    sgs = [ pm.PyNode(_sgs[i]) for i in xrange(_sgs.length()) ]
+    sgf = array('i', _ids)
+    if -1 in sgf:
+        sgf = array('i', [ max(i, 0) for i in sgf ])
+    return sgs, sgf
+
+
+def bulkWeights(skin, shp):
+    # weights of every vertex of shp on every influence of skin, read at once as a (vertices, influences) array
+    # columns follow skin.getInfluence(), None if the api call fails
+    try:
+        fn = oma.MFnSkinCluster( skin.__apiobject__() )
+        path = shp.__apimdagpath__()
+
+        _comp = om.MFnSingleIndexedComponent()
+        comp = _comp.create( om.MFn.kMeshVertComponent )
+        _comp.setCompleteData( om.MFnMesh(path).numVertices() )
+
+        _w = om.MDoubleArray()
+        _util = om.MScriptUtil()
+        _util.createFromInt(0)
+        _count = _util.asUintPtr()
+        fn.getWeights( path, comp, _w, _count )
+        count = om.MScriptUtil.getUint(_count)
+    except Exception:
+        return None
+
+    return toArray(_w).reshape(-1, max(count, 1))
+
+
+def topWeights(weights, count=2):
+    # column and normalized weight of the `count` heaviest influences of each vertex, heaviest first
+    # weights: (vertices, influences) array, top count picked by argpartition without sorting whole rows
+    # among equal weights the last influence wins and comes first, as with a stable sort of the row:
+    # rows where argpartition had to choose among weights tied at the cut are picked again by a stable argsort
+    # skins with less than count influences are padded with column -1 and weight 0
+    weights = numpy.asarray( list(weights) if not hasattr(weights, '__len__') else weights, numpy.float64 )
+    weights = weights.reshape( len(weights), -1 )
+    nv, ni = weights.shape
+    k = min(count, ni)
+
+    if k < ni:
+        cols = numpy.argpartition(weights, ni-k, axis=1)[:,ni-k:]
+        cut = weights[ numpy.arange(nv)[:,None], cols ].min(1)[:,None]
+        ties = numpy.flatnonzero( (weights == cut).sum(1) > k - (weights > cut).sum(1) )
+        if len(ties):
+            cols[ties] = numpy.argsort( weights[ties], axis=1, kind='mergesort' )[:,ni-k:]
+    else:
+        cols = numpy.tile( numpy.arange(ni), (nv, 1) )
+
+    rows = numpy.arange(nv)[:,None]
+    w = weights[rows, cols]
+    order = numpy.lexsort( (-cols, -w) )
+    cols = cols[rows, order]
+    w = w[rows, order]
+
+    total = w.sum(1)
+    total[total == 0] = 1.0
+    w = w / total[:,None]
+    if k == 1:
+        w[:] = 1.0
+
+    if k < count:
+        cols = numpy.column_stack( (cols, -numpy.ones((nv, count-k), numpy.int64)) )
+        w = numpy.column_stack( (w, numpy.zeros((nv, count-k))) )
+
+    return cols, w
+
+
+def shaderNetwork(mat, names=True):
+    # names, types and attribute values of a shader and the nodes feeding it, as a string to fingerprint
+    # names=False: node names are left out (with the nodes feeding each attribute replaced by their type)
+    # and nodes sorted by content, so networks only differing by their names give the same string
+    nodes = []
+    for node in sorted( pm.listHistory(mat), key=str ):
+        network = [ '%s %s' % (node if names else '', pm.nodeType(node)) ]
+        for attr in pm.listAttr(node, scalar=True, settable=True) or []:
+            try:
+                network.append( '%s=%r' % ( attr, pm.getAttr('%s.%s' % (node, attr)) ) )
+            except Exception:
+                pass
+
+        if not names:
+            for dst, src in node.inputs(connections=True, plugs=True):
+                network.append( '%s<%s.%s' % ( dst.longName(), pm.nodeType(src.node()), src.longName() ) )
+
+            # images read by the network change its bake without changing its attributes
+            if pm.nodeType(node) == 'file':
+                f = node.fileTextureName.get()
+                if f and os.path.isfile(f):
+                    network.append( 'mtime=%r' % os.path.getmtime(f) )
+
+        nodes.append( '\n'.join(network) )
+
+    if not names:
+        nodes.sort()
+    return '\n'.join(nodes)
+
+
+def componentIndices(comps):
+    # indices of component strings such as 'vtx[4]' or 'vtx[10:15]'
+    indices = []
+    for c in comps:
+        c = c.split('[')[1].split(']')[0]
+        if ':' in c:
+            a, b = c.split(':')
+            indices += range( int(a), int(b)+1 )
+        else:
+            indices.append( int(c) )
+    return indices
+
+
+def packColors(rgb):
+    # rgb floats to the 24 bits ints three.js expects
+    rgb = (rgb[:,:3] * 255).astype(numpy.int64)
+    return (rgb[:,0]<<16) + (rgb[:,1]<<8) + rgb[:,2]
+
+
+def encodeFaces(counts, vtx, normals, mats=None, uvs=None, colors=None):
+    # interleave per face-vertex indices into the three.js face stream, polygons above 4 vertices are left out
+    # counts: vertex count of each face
+    # vtx, normals, uvs, colors: index of each face-vertex, uvs are -1 on unmapped faces, colors -1 for white
+    # mats: material id of each face or a single id for all of them
+    # returns the face stream and the INDEX_* kind of each of its entries
+    fvface = numpy.repeat( numpy.arange(len(counts)), counts )
+    fvkeep = (counts <= 4)[fvface]
+
+    keep = counts <= 4
+    n = counts[keep]
+    vtx = vtx[fvkeep]
+    normals = normals[fvkeep]
+
+    fvface = numpy.repeat( numpy.arange(len(n)), n )
+    fvn = n[fvface]
+    corner = numpy.arange(len(fvface)) - (numpy.cumsum(n) - n)[fvface]
+
+    # face flags and length
+    flags = numpy.where(n == 4, FACE_QUAD, 0) + FACE_VERTEX_NORMAL
+    size = 1 + 2*n
+
+    if mats is not None:
+        flags += FACE_MATERIAL
+        size += 1
+        if numpy.ndim(mats):
+            mats = numpy.asarray(mats)[keep]
+
+    hasuv = numpy.zeros(len(n), bool)
+    if uvs is not None:
+        uvs = uvs[fvkeep]
+        hasuv[:] = uvs[ numpy.cumsum(n) - n ] >= 0
+        flags += hasuv * FACE_VERTEX_UV
+        size += hasuv * n
+
+    if colors is not None:
+        colors = colors[fvkeep]
+        flags += FACE_VERTEX_COLOR
+        size += n
+
+    start = numpy.cumsum(size) - size
+    faces = numpy.empty(size.sum(), numpy.int64)
+    kinds = numpy.zeros(size.sum(), numpy.int8)
+
+    # [flags, vertices, material, uvs, normals, colors]
+    faces[start] = flags
+    fvstart = start[fvface] + 1
+    faces[fvstart + corner] = vtx
+    kinds[fvstart + corner] = INDEX_VERTEX
+    fvstart += fvn
+
+    if mats is not None:
+        faces[start + 1 + n] = mats
+        kinds[start + 1 + n] = INDEX_MATERIAL
+        fvstart += 1
+
+    if uvs is not None:
+        fvuv = hasuv[fvface]
+        faces[ (fvstart + corner)[fvuv] ] = uvs[fvuv]
+        kinds[ (fvstart + corner)[fvuv] ] = INDEX_UV
+        fvstart += fvn * fvuv
+
+    faces[fvstart + corner] = normals
+    kinds[fvstart + corner] = INDEX_NORMAL
+    fvstart += fvn
+
+    if colors is not None:
+        faces[fvstart + corner] = numpy.maximum(colors, 0)
+        kinds[fvstart + corner] = numpy.where(colors >= 0, INDEX_COLOR, INDEX_NONE)
+
+    return faces, kinds
@@ -0,0 +1,239 @@
+# Batch export of maya scene files, run with mayapy
+#
+#   mayapy threeMayaBatch.py manifest.json --workers 8 --summary summary.json
+#
+# the manifest is a json list of jobs, paths are relative to the manifest folder:
+#
+#   {
+#     "scene": "hero/hero.mb",
+#     "output": "build/models/hero",      writes hero.js (and hero.bin) in build/models
+#     "roots": ["hero_grp"],              transforms to export, every visible mesh if missing
+#     "skeleton": true,                   skinClusters and bones
+#     "influences": 2,                    joints per vertex
+#     "animation": [0, 100],              single anim0 clip, end excluded
+#     "clips": [["walk", 0, 40]],         named clips, or "scene" to read the time editor clips / bookmarks
+#     "reduce": false,                    keyframe reduction, or [posTolerance, rotTolerance]
+#     "morphTargets": false,              blendShape targets, or "dense"
+#     "binary": false,
+#     "quantize": false,
+#     "compact": false,
+#     "octNormals": false,                two integers per normal in binary or compact output
+#     "cache": "build/cache",             re-export cache folder, see threeMaya.GeometryCache,
+#                                         jobs and worker processes can share the same one
+#     "instances": false                  export identical meshes once, see threeMaya.Exporter.findInstances
+#   }
+#
+# jobs are spread over a pool of mayapy processes, each one opening its scenes in turn.
+# the summary file gets the status, error, output size, wall time and time per export stage
+# of each job, it is rewritten as jobs end so a killed build still leaves it.
+# the script exits with 1 if a job failed
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+
+
+def initWorker():
+    # start maya in this process, before threeMaya imports pymel
+    import maya.standalone
+    maya.standalone.initialize(name='python')
+
+
+def openScene(path):
+    # open a scene file and return the MayaScene reading it
+    import pymel.core as pm
+    import threeMaya
+
+    pm.openFile(path, force=True)
+    return threeMaya.MayaScene()
+
+
+def loadManifest(path):
+    # jobs of a manifest file with their paths made absolute
+    f = open(path)
+    try:
+        jobs = json.load(f)
+    finally:
+        f.close()
+
+    root = os.path.dirname( os.path.abspath(path) )
+    for job in jobs:
+        for k in ('scene', 'output', 'cache'):
+            if job.get(k):
+                job[k] = os.path.normpath( os.path.join(root, job[k]) )
+    return jobs
+
+
+
+def exportJob(job, scene):
+    # run the export described by a manifest job on an opened scene, returns the exporter
+    import threeMaya
+
+    kwargs = { 'scene': scene }
+    if job.get('cache'):
+        kwargs['cache'] = job['cache']
+    if job.get('instances'):
+        kwargs['instances'] = True
+
+    e = threeMaya.Exporter( *job.get('roots', []), **kwargs )
+    if 'vertices' not in e.db:
+        raise RuntimeError('geometry export failed, see the log above')
+
+    if job.get('morphTargets'):
+        e.exportMorphTargets( dense=job['morphTargets'] == 'dense' )
+
+    if job.get('skeleton', True):
+        e.exportSkeleton( job.get('influences', 2) )
+
+        if 'bones' in e.db:
+            if job.get('animation'):
+                e.exportAnimation( *job['animation'] )
+            if job.get('clips'):
+                clips = job['clips']
+                if clips == 'scene':
+                    clips = None
+                e.exportAnimations(clips)
+
+            reduce = job.get('reduce')
+            if reduce:
+                if reduce is True:
+                    reduce = []
+                e.reduceAnimation(*reduce)
+
+    path, name = os.path.split( job['output'] )
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    e.write( name, path, compact=job.get('compact', False), binary=job.get('binary', False),
+             quantize=job.get('quantize', False), octNormals=job.get('octNormals', False) )
+    return e
+
+
+def runJob(args):
+    # export one job in a worker, never raises: failures are reported in the returned status
+    index, job = args
+
+    status = {
+        'index': index,
+        'scene': job.get('scene'),
+        'output': job.get('output'),
+        'worker': os.getpid(),
+        'status': 'ok',
+        'error': None,
+        'bytes': None,
+        'stages': {},
+        }
+
+    wall = time.time()
+    try:
+        t = time.time()
+        scene = openScene( job['scene'] )
+        status['stages']['open'] = time.time() - t
+
+        e = exportJob(job, scene)
+
+        for name, total in e.report.totals().items():
+            status['stages'][name] = total['wall']
+        status['bytes'] = sum( r['count'] or 0 for r in e.report.records if r['stage'] == 'write' )
+
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc()
+
+    status['wall'] = time.time() - wall
+    return status
+
+
+
+def batch(jobs, workers=1, summary=None, maxTasks=None):
+    # run the jobs over a pool of worker processes, 0 for one per cpu, and return their statuses in manifest order
+    # maxTasks: jobs run by a worker before it is replaced by a fresh one
+
+    start = time.strftime('%Y-%m-%d %H:%M:%S')
+    wall = time.time()
+    results = []
+
+    def save():
+        if summary:
+            done = sorted( results, key=lambda r: r['index'] )
+            writeSummary( summary, {
+                'started': start,
+                'wall': time.time() - wall,
+                'workers': workers,
+                'jobs': len(jobs),
+                'ok': sum( r['status'] == 'ok' for r in done ),
+                'failed': sum( r['status'] != 'ok' for r in done ),
+                'results': done,
+                } )
+
+    if workers == 1:
+        initWorker()
+        statuses = ( runJob(x) for x in enumerate(jobs) )
+        pool = None
+    else:
+        pool = multiprocessing.Pool( workers or None, initWorker, maxtasksperchild=maxTasks )
+        statuses = pool.imap_unordered( runJob, enumerate(jobs) )
+
+    try:
+        for r in statuses:
+            results.append(r)
+            print '# [%d/%d] %-6s %7.1fs %s' % ( len(results), len(jobs), r['status'], r['wall'], r['scene'] )
+            if r['error']:
+                print r['error']
+            sys.stdout.flush()
+            save()
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+    return sorted( results, key=lambda r: r['index'] )
+
+
+def writeSummary(path, summary):
+    # the new summary is renamed over the previous one, which windows doesn't allow: it is removed first
+    f = open(path + '.tmp', 'w')
+    try:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser( description='export maya scenes to three.js models, run with mayapy' )
+    parser.add_argument( 'manifest', help='json list of export jobs' )
+    parser.add_argument( '--workers', type=int, default=1, help='mayapy processes, 0 for one per cpu' )
+    parser.add_argument( '--summary', help='json file the status and timings of each job are written to' )
+    parser.add_argument( '--max-tasks', type=int, help='jobs per worker before it is restarted' )
+    args = parser.parse_args(argv)
+
+    jobs = loadManifest(args.manifest)
+    print '# %d jobs, %s workers' % ( len(jobs), args.workers or multiprocessing.cpu_count() )
+
+    results = batch( jobs, args.workers, args.summary, args.max_tasks )
+
+    failed = [ r for r in results if r['status'] != 'ok' ]
+    print '# %d ok, %d failed' % ( len(results) - len(failed), len(failed) )
+    if failed:
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
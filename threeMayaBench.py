@@ -0,0 +1,357 @@
+# Benchmarks of the threeMaya export stages on synthetic scenes (threeMayaMock)
+#
+# each stage is swept over a grid of parameters (faces, uv split ratio, material count,
+# bone count, frame range), every case runs in its own process so its peak memory can be read
+#
+#   python threeMayaBench.py --output bench.json
+#   python threeMayaBench.py --quick --stages uvs,faces --baseline bench.json --threshold 0.2
+#
+# results are written as json: wall time (best of --repeat runs), peak rss of the case process
+# (its setup included, so it bounds the stage memory rather than measuring it), output bytes and
+# element counts. a case whose process dies or runs over --timeout is recorded as failed.
+# with --baseline, cases slower than baseline*(1+threshold) and by more than NOISE seconds
+# are reported, and the script exits with 1 on regressions and failed cases
+
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import itertools
+import multiprocessing
+import Queue
+
+import numpy
+
+import threeMaya
+import threeMayaMock
+
+
+FACES  = (1000, 10000, 100000, 1000000, 5000000)
+SPLITS = (0.0, 0.1, 0.5)
+NGONS  = (0.1, 0.5)
+MATERIALS = (1, 8, 32)
+BONES  = (10, 60, 200)
+FRAMES = (24, 240)
+
+QUICK_FACES = 100000
+
+# slowdown in seconds below which a case isn't a regression, whatever its ratio (timer jitter)
+NOISE = 0.005
+
+# seconds a case process may run before it is killed and the case failed
+TIMEOUT = 3600
+
+
+
+def meshRaw(faces, uvSplit=0.0, materials=1, colors=False, ngons=0.0):
+    # raw buffers of a mock mesh, as extractGeometry returns them
+    scene = threeMayaMock.MockScene()
+    scene.addMesh('bench', faces=faces, uvSplit=uvSplit, materials=materials, colors=colors, ngons=ngons)
+    msh, shp = scene.meshes()[0]
+
+    mats, faceShaders = scene.shading(shp)
+    raw = scene.buffers(shp, colors)
+    raw['name'] = 'bench'
+    raw['shaders'] = range(len(mats))
+    raw['faceShaders'] = None
+    if len(mats) > 1:
+        raw['faceShaders'] = faceShaders
+    return raw
+
+
+def meshExporter(faces, bones=0, frames=0):
+    scene = threeMayaMock.MockScene()
+    scene.addMesh('bench', faces=faces)
+    if bones:
+        scene.addSkeleton(bones=bones, frames=frames)
+    return threeMaya.Exporter(scene=scene)
+
+
+
+# stages: setup(**params) returns the context given to run(context), which returns (elements, bytes)
+
+def setupVertices(faces):
+    raw = meshRaw(faces)
+    return raw['points'].reshape(-1,3), raw['normals'].reshape(-1,3), numpy.eye(4)
+
+def runVertices(ctx):
+    pts, normals, m = ctx
+    pts = numpy.round( threeMaya.transformPoints(pts, m), threeMaya.DECIMALS_VERTICES )
+    normals = numpy.round( threeMaya.transformNormals(normals, m), threeMaya.DECIMALS_NORMALS )
+    return len(pts) + len(normals), 0
+
+
+def setupNormals(faces):
+    raw = meshRaw(faces)
+    return numpy.round( raw['normals'], threeMaya.DECIMALS_NORMALS ), raw['normalIds']
+
+def runNormals(ctx):
+    normals, ids = threeMaya.weldNormals(*ctx)
+    return len(normals)/3, 0
+
+
+def setupUVs(faces, uvSplit):
+    raw = meshRaw(faces, uvSplit)
+    return raw['vertices'], raw['us'][raw['uvIds']], raw['vs'][raw['uvIds']]
+
+def runUVs(ctx):
+    ids, uvs = threeMaya.weldUVs(*ctx)
+    return len(uvs)/2, 0
+
+
+def setupFaces(faces):
+    raw = meshRaw(faces)
+    return raw['counts'], raw['vertices'], raw['normalIds'], 0, raw['vertices'].copy()
+
+def runFaces(ctx):
+    counts, vtx, normals, mats, uvs = ctx
+    faces, kinds = threeMaya.encodeFaces(counts, vtx, normals, mats, uvs)
+    return len(faces), 0
+
+
+def setupNgons(faces, ngons):
+    return meshRaw(faces, ngons=ngons)
+
+def runNgons(raw):
+    raw = threeMaya.splitPolygons(raw)
+    return len(raw['counts']), 0
+
+
+def setupMaterials(faces, materials):
+    return meshRaw(faces, materials=materials)
+
+def runMaterials(raw):
+    geo = threeMaya.buildGeometry(raw)
+    return geo['faceCount'], 0
+
+
+def setupSkin(faces, bones):
+    return meshExporter(faces, bones, 1)
+
+def runSkin(e):
+    e.exportSkeleton()
+    return len(e.db['skinWeights']), 0
+
+
+def setupAnimation(bones, frames):
+    e = meshExporter(1000, bones, frames)
+    e.exportSkeleton()
+
+    # the mock chains its bone matrices in python, they are sampled before the timer
+    # so the stage only times the exporter (sampleFrames, buildAnimation)
+    world = e.scene.worldMatrices( e.infs, range(frames) )
+    e.scene.worldMatrices = lambda nodes, times: world[ numpy.asarray(times, numpy.int64) ]
+    return e, frames
+
+def runAnimation(ctx):
+    e, frames = ctx
+    e.exportAnimation(0, frames)
+    return len(e.infs) * frames, 0
+
+
+def setupEncode(faces):
+    return meshExporter(faces)
+
+def runEncode(e):
+    dump = e.encode()
+    return len(e.db['faces']), len(dump)
+
+
+def setupWrite(faces, dump):
+    return meshExporter(faces), tempfile.mkdtemp(), dump
+
+def runWrite(ctx):
+    e, path, dump = ctx
+    try:
+        e.write('bench', path, dump)
+        return len(e.db['faces']), os.path.getsize( os.path.join(path, 'bench.js') )
+    finally:
+        shutil.rmtree(path)
+
+
+STAGES = (
+    ( 'vertices',  setupVertices,  runVertices,  {'faces': FACES} ),
+    ( 'normals',   setupNormals,   runNormals,   {'faces': FACES} ),
+    ( 'uvs',       setupUVs,       runUVs,       {'faces': FACES, 'uvSplit': SPLITS} ),
+    ( 'faces',     setupFaces,     runFaces,     {'faces': FACES} ),
+    ( 'ngons',     setupNgons,     runNgons,     {'faces': FACES, 'ngons': NGONS} ),
+    ( 'materials', setupMaterials, runMaterials, {'faces': FACES, 'materials': MATERIALS} ),
+    ( 'skin',      setupSkin,      runSkin,      {'faces': FACES[:3], 'bones': BONES} ),
+    ( 'animation', setupAnimation, runAnimation, {'bones': BONES, 'frames': FRAMES} ),
+    ( 'encode',    setupEncode,    runEncode,    {'faces': FACES} ),
+    ( 'write',     setupWrite,     runWrite,     {'faces': FACES, 'dump': (False, True)} ),
+    )
+
+
+
+def cases(stages=None, maxFaces=None):
+    # (stage, params) of every benchmark case
+    for name, setup, run, grid in STAGES:
+        if stages and name not in stages:
+            continue
+        keys = sorted(grid)
+        for values in itertools.product( *[grid[k] for k in keys] ):
+            params = dict( zip(keys, values) )
+            if maxFaces and params.get('faces', 0) > maxFaces:
+                continue
+            yield name, params
+
+
+def runCase(name, params, repeat, queue):
+    # run in a child process: setup once, time run() repeat times
+    setup, run = [ (s, r) for n, s, r, g in STAGES if n == name ][0]
+
+    best = None
+    for i in xrange(repeat):
+        ctx = setup(**params)
+        gc.collect()
+
+        t = time.time()
+        elements, size = run(ctx)
+        t = time.time() - t
+
+        if best is None or t < best:
+            best = t
+        del ctx
+
+    # rss is the peak of this process, setup included
+    queue.put( {
+        'stage': name,
+        'params': params,
+        'time': round(best, 6),
+        'rss': round(threeMaya.peakMemory() or 0, 1),
+        'bytes': size,
+        'elements': elements,
+        } )
+
+
+def waitCase(p, queue, timeout):
+    # result of the case process p, or the reason it gave none: it crashed (exit code) or ran over timeout
+    start = time.time()
+    while True:
+        try:
+            return queue.get(timeout=1), None
+        except Queue.Empty:
+            pass
+
+        if not p.is_alive():
+            # the result may have been sent just before the process ended
+            try:
+                return queue.get(timeout=1), None
+            except Queue.Empty:
+                return None, 'exit code %s' % p.exitcode
+
+        if timeout and time.time() - start > timeout:
+            p.terminate()
+            return None, 'timeout after %ds' % timeout
+
+
+def bench(stages=None, maxFaces=None, repeat=3, timeout=TIMEOUT):
+
+    results = []
+    for name, params in cases(stages, maxFaces):
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process( target=runCase, args=(name, params, repeat, queue) )
+        p.start()
+        r, error = waitCase(p, queue, timeout)
+        p.join()
+
+        if r is None:
+            r = { 'stage': name, 'params': params, 'time': None, 'rss': None, 'bytes': None, 'elements': None, 'error': error }
+            print '%-10s %-40s FAILED (%s)' % ( name, caseKey(r)[len(name)+1:], error )
+        else:
+            print '%-10s %-40s %10.4fs %8.1fMB %12s bytes' % ( name, caseKey(r)[len(name)+1:], r['time'], r['rss'], r['bytes'] )
+        sys.stdout.flush()
+        results.append(r)
+
+    return {
+        'version': threeMaya.__version__,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'results': results,
+        }
+
+
+def caseKey(r):
+    return '%s %s' % ( r['stage'], ' '.join( '%s=%s' % (k, r['params'][k]) for k in sorted(r['params']) ) )
+
+
+def compare(report, baseline, threshold=0.2, noise=NOISE):
+    # cases slower than their baseline by more than threshold and noise seconds, as (key, time, baseline time)
+    # failed cases are left out, on either side
+    base = dict( (caseKey(r), r) for r in baseline['results'] )
+
+    regressions = []
+    for r in report['results']:
+        b = base.get( caseKey(r) )
+        if b is None or r['time'] is None or b['time'] is None:
+            continue
+        if r['time'] > b['time'] * (1+threshold) and r['time'] - b['time'] > noise:
+            regressions.append( (caseKey(r), r['time'], b['time']) )
+    return regressions
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser( description='benchmark threeMaya export stages on synthetic scenes' )
+    parser.add_argument( '--output', help='json file the results are written to' )
+    parser.add_argument( '--baseline', help='json results to compare with' )
+    parser.add_argument( '--threshold', type=float, default=0.2, help='allowed slowdown ratio before a case is a regression' )
+    parser.add_argument( '--stages', help='comma separated stages to run: %s' % ','.join(s[0] for s in STAGES) )
+    parser.add_argument( '--max-faces', type=int, help='skip cases above this face count' )
+    parser.add_argument( '--quick', action='store_true', help='same as --max-faces %s' % QUICK_FACES )
+    parser.add_argument( '--repeat', type=int, default=3, help='runs per case, the best one is kept' )
+    parser.add_argument( '--timeout', type=float, default=TIMEOUT, help='seconds before a case is killed and failed, 0 for none' )
+    args = parser.parse_args(argv)
+
+    stages = None
+    if args.stages:
+        stages = args.stages.split(',')
+
+    maxFaces = args.max_faces
+    if args.quick and not maxFaces:
+        maxFaces = QUICK_FACES
+
+    report = bench(stages, maxFaces, args.repeat, args.timeout)
+    failed = [ r for r in report['results'] if r['time'] is None ]
+
+    if args.output:
+        f = open(args.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+
+        regressions = compare(report, baseline, args.threshold)
+        for key, t, b in regressions:
+            print '# REGRESSION %s: %.4fs (baseline %.4fs, x%.2f)' % (key, t, b, t/b)
+        if not regressions:
+            print '# no regression above %d%%' % (args.threshold*100)
+
+    for r in failed:
+        print '# FAILED %s: %s' % (caseKey(r), r['error'])
+
+    if failed or args.baseline and regressions:
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,418 @@
+# Stand-in for threeMaya.MayaScene
+# builds synthetic meshes, skinClusters and keyed skeletons of any size in memory
+# so the exporter can be run, profiled and tested without maya
+#
+#   import threeMaya, threeMayaMock
+#
+#   scene = threeMayaMock.MockScene()
+#   scene.addMesh('body', faces=200000, uvSplit=0.1, materials=4)
+#   scene.addSkeleton(bones=60, frames=100, meshes=['body'])
+#
+#   e = threeMaya.Exporter('body', scene=scene)
+#   e.exportSkeleton()
+#   e.exportAnimation(0, 100)
+#
+#   scene.addClip('walk', 0, 40)
+#   scene.addClip('run', 30, 100)
+#   e.exportAnimations()
+#   e.write('body', '/tmp')
+
+
+import math
+import numpy
+from array import array
+
+import threeMaya
+
+
+
+class MockNode(object):
+    # scene node, only compared by identity and printed by name
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+
+    def __str__(self):
+        return self.name
+
+    __repr__ = __str__
+
+
+
+class MockScene(object):
+
+    def __init__(self, seed=0, fps=24):
+
+        self.random = numpy.random.RandomState(seed)
+        self._fps = fps
+
+        self.transforms = []
+        self.shapes = {}
+        self.bones = []
+        self.frames = 0
+        self._clips = []
+        self._textures = {}
+        self._matrices = {}
+        self.bakes = 0
+
+
+
+    def addMesh(self, name, faces=1000, uvSplit=0.0, materials=1, colors=False, offset=(0,0,0), ngons=0.0):
+        # quad grid of about `faces` faces
+        # uvSplit: ratio of faces cut out of the shared uv layout into their own island
+        # materials: number of materials, assigned to consecutive blocks of faces
+        # colors: paint face-vertices with a few colors
+        # ngons: ratio of side by side quad pairs merged into hexagons, triangulated as maya's getTriangles does
+
+        w = max( 1, int(math.sqrt(faces)) )
+        h = max( 1, faces / w )
+        nf = w*h
+
+        # points, with a bit of relief to get proper normals
+        x, y = numpy.meshgrid( numpy.arange(w+1, dtype=numpy.float64), numpy.arange(h+1, dtype=numpy.float64) )
+        z = numpy.sin(x*0.3) * numpy.cos(y*0.2)
+        points = numpy.column_stack( (x.ravel(), y.ravel(), z.ravel()) )
+
+        _n = numpy.column_stack( ( (-0.3*numpy.cos(x*0.3)*numpy.cos(y*0.2)).ravel(),
+                                   (0.2*numpy.sin(x*0.3)*numpy.sin(y*0.2)).ravel(),
+                                   numpy.ones(x.size) ) )
+        normals = _n / numpy.sqrt( (_n*_n).sum(1) )[:,None]
+
+        # quads
+        i, j = numpy.meshgrid( numpy.arange(w), numpy.arange(h) )
+        v00 = (j*(w+1) + i).ravel()
+        vtx = numpy.column_stack( (v00, v00+1, v00+w+2, v00+w+1) ).ravel()
+        counts = numpy.empty(nf, numpy.int64)
+        counts.fill(4)
+
+        # hexagons: a quad takes the corners of the next one, which is removed
+        if ngons:
+            merged = (i.ravel() % 2 == 0) & (i.ravel() + 1 < w)
+            merged &= self.random.random_sample(nf) < ngons
+            corners = numpy.column_stack( (v00, v00+1, v00+2, v00+w+3, v00+w+2, v00+w+1) )
+            corners[~merged, 2:4] = corners[~merged, 4:6]
+            counts[merged] = 6
+            kept = ~numpy.roll(merged, 1)
+            counts, corners = counts[kept], corners[kept]
+            vtx = corners[ numpy.arange(6) < counts[:,None] ]
+            nf = len(counts)
+
+        # uvs: one per point, split faces get their own shifted ones
+        us = x.ravel() / w
+        vs = y.ravel() / h
+        uvids = vtx.copy()
+
+        split = self.random.random_sample(nf) < uvSplit
+        if split.any():
+            fvsplit = numpy.repeat(split, counts)
+            n = fvsplit.sum()
+            uvids[fvsplit] = len(us) + numpy.arange(n)
+            us = numpy.concatenate( (us, us[vtx[fvsplit]] + 1) )
+            vs = numpy.concatenate( (vs, vs[vtx[fvsplit]]) )
+
+        raw = {
+            'points': points.ravel(),
+            'normals': normals.ravel(),
+            'counts': counts,
+            'vertices': vtx,
+            'normalIds': vtx.copy(),
+            'uvCounts': counts.copy(),
+            'uvIds': uvids,
+            'us': us,
+            'vs': vs,
+            'colors': None,
+            }
+
+        if colors:
+            palette = numpy.array( [ (1,1,1,1), (1,0,0,1), (0,1,0,1), (0,0,1,1), (1,1,0,1) ], numpy.float64 )
+            raw['colors'] = palette[ numpy.repeat(numpy.arange(nf) % len(palette), counts) ].ravel()
+
+        # every face is triangulated like MFnMesh.getTriangles, in vertex indices
+        # fans around the second corner, so triangles don't simply follow the face-vertices
+        if ngons:
+            tn = counts - 2
+            face = numpy.repeat( numpy.arange(nf), tn )
+            k = numpy.arange(len(face)) - (numpy.cumsum(tn) - tn)[face]
+            first = (numpy.cumsum(counts) - counts)[face]
+            n = counts[face]
+            raw['triangleCounts'] = tn
+            raw['triangleVertices'] = vtx[ numpy.column_stack( (first + 1, first + (k+2) % n, first + (k+3) % n) ) ].ravel()
+
+        materials = max(1, materials)
+        mats = [ MockNode('%s_material%d' % (name, m)) for m in xrange(materials) ]
+        faceShaders = array( 'i', (numpy.arange(nf) * materials / nf).tolist() )
+
+        # the offset is the translation of the mesh transform
+        msh = MockNode(name)
+        msh.offset = offset
+        msh.axis = 2
+        msh.amplitude = 0.0
+        msh.phase = 0.0
+        self.transforms.append(msh)
+        self.shapes[msh] = {
+            'shape': MockNode(name+'Shape', msh),
+            'raw': raw,
+            'materials': mats,
+            'faceShaders': faceShaders,
+            'colors': colors,
+            'skin': None,
+            'morphs': (0, 0.0),
+            }
+        return msh
+
+
+
+    def addInstance(self, name, mesh, offset=(0,0,0), rotation=0.0):
+        # another transform of the shape of the mesh named `mesh`, turned by `rotation` radians around z and moved by offset
+        # the exporter can't tell it from a duplicate with the same materials
+
+        src = [ msh for msh in self.transforms if str(msh) == mesh ][0]
+
+        msh = MockNode(name)
+        msh.offset = offset
+        msh.axis = 2
+        msh.amplitude = rotation
+        msh.phase = math.pi / 2
+        self.transforms.append(msh)
+        self.shapes[msh] = dict( self.shapes[src], shape=MockNode(name+'Shape', msh) )
+        return msh
+
+
+
+    def addSkeleton(self, bones=10, frames=100, meshes=None, influences=4, branches=1):
+        # joint chains animated from frame 0 to `frames`, skinning the given mesh names (all of them by default)
+        # influences: non zero weights per vertex
+        # branches: number of chains hanging from the root
+
+        root = MockNode('root')
+        self.bones = [root]
+        root.offset = (0, 0, 0)
+        root.axis = 2
+        root.amplitude = 0.0
+        root.phase = 0.0
+
+        for b in xrange(1, bones):
+            parent = root
+            if b > branches:
+                parent = self.bones[b - branches]
+            node = MockNode('joint%d' % b, parent)
+            node.offset = (0, 1.0, 0)
+            node.axis = b % 3
+            node.amplitude = 0.5 * self.random.random_sample()
+            node.phase = 2 * math.pi * self.random.random_sample()
+            self.bones.append(node)
+
+        self.frames = frames
+        self._matrices = {}
+
+        for msh in self.transforms:
+            infos = self.shapes[msh]
+            if meshes is not None and str(msh) not in meshes:
+                continue
+
+            nv = len( infos['raw']['points'] ) / 3
+            k = min(influences, bones)
+            weights = numpy.zeros( (nv, bones) )
+            ids = numpy.argsort( self.random.random_sample((nv, bones)), 1 )[:, :k]
+            w = self.random.random_sample( (nv, k) ) + 0.01
+            weights[ numpy.arange(nv)[:,None], ids ] = w / w.sum(1)[:,None]
+            infos['skin'] = ( list(self.bones), weights )
+
+        return root
+
+
+
+    def addBlendShape(self, mesh, targets=10, ratio=0.1):
+        # blendShape targets on a mesh, each one moving about `ratio` of its vertices
+        # a few more vertices get offsets too small to be exported, deltas are built when read
+        for msh in self.transforms:
+            if str(msh) == mesh:
+                self.shapes[msh]['morphs'] = (targets, ratio)
+
+
+    def addClip(self, name, start, end):
+        # clip returned by clips(), end excluded
+        self._clips.append( (name, start, end) )
+
+
+    def addTexture(self, material, mode='mapDiffuse', network='checker'):
+        # procedural texture feeding `mode` of a material (named '<mesh>_material<i>'), baked by bake()
+        # textures of the same network string are identical networks of different nodes
+        node = MockNode( '%s_%s' % (material, mode) )
+        node.network = network
+        self._textures.setdefault(material, []).append( (mode, node) )
+        return node
+
+
+
+    # MayaScene interface
+
+    def reset(self):
+        pass
+
+
+    def release(self, shp):
+        pass
+
+
+    def meshes(self, *args):
+
+        meshes = []
+        for msh in self.transforms:
+            if not args or str(msh) in args:
+                meshes.append( (msh, self.shapes[msh]['shape']) )
+        return meshes
+
+
+    def _infos(self, shp):
+        return self.shapes[shp.parent]
+
+
+    def shading(self, shp):
+        infos = self._infos(shp)
+        return infos['materials'], infos['faceShaders']
+
+
+    def shapeInfo(self, shp):
+        return {
+            'displayColors': self._infos(shp)['colors'],
+            'doubleSided': True,
+            'opposite': False,
+            }
+
+
+    def material(self, mat):
+        # the same material always gets the same color
+        _r = numpy.random.RandomState( sum(map(ord, str(mat))) )
+        c = [ round(float(x), threeMaya.DECIMALS_COLOR) for x in _r.random_sample(3) ]
+        m = {
+            'shading': 'Phong',
+            'colorDiffuse': c,
+            'colorAmbient': [0,0,0],
+            'colorSpecular': [0,0,0],
+            }
+        textures = [ { 'mode': mode, 'bake': node } for mode, node in self._textures.get(str(mat), []) ]
+        return m, textures
+
+
+    def buffers(self, shp, colors=False, local=False):
+        raw = dict( self._infos(shp)['raw'] )
+        if not colors:
+            raw['colors'] = None
+
+        # world space: translated, and rotated for the instances turned by addInstance
+        if not local:
+            m = numpy.array( self.worldMatrix(shp.parent) )
+            pts = raw['points'].reshape(-1, 3)
+            if (m[:3,:3] != numpy.eye(3)).any():
+                pts = numpy.dot(pts, m[:3,:3])
+                raw['normals'] = threeMaya.transformNormals( raw['normals'].reshape(-1, 3), m ).ravel()
+            raw['points'] = (pts + m[3,:3]).ravel()
+        return raw
+
+
+    def fingerprint(self, shp, local=False):
+        infos = self._infos(shp)
+        raw = self.buffers(shp, infos['colors'], local)
+        values = [ raw[k] for k in sorted(raw) if raw[k] is not None ]
+        values += [ map(str, infos['materials']), infos['colors'], numpy.frombuffer(infos['faceShaders'], numpy.int32) ]
+        return threeMaya.digest(values)
+
+
+    def deformed(self, shp):
+        infos = self._infos(shp)
+        return infos['skin'] is not None or infos['morphs'][0] > 0
+
+
+    def network(self, node):
+        return threeMaya.digest( [node.network] )
+
+
+    def bake(self, node, path, resolution):
+        # image of a gradient, seeded by the network
+        _r = numpy.random.RandomState( sum(map(ord, node.network)) )
+        x, y = numpy.meshgrid( numpy.linspace(0, 1, resolution), numpy.linspace(0, 1, resolution) )
+        rgb = numpy.dstack( (x, y, _r.random_sample() + 0*x) ) * 255
+        f = open(path, 'wb')
+        try:
+            f.write( 'P6 %d %d 255\n' % (resolution, resolution) )
+            f.write( rgb.astype(numpy.uint8).tobytes() )
+        finally:
+            f.close()
+        self.bakes += 1
+
+
+    def skin(self, shp):
+        return self._infos(shp)['skin']
+
+
+    def morphTargets(self, shp):
+        infos = self._infos(shp)
+        targets, ratio = infos['morphs']
+        nv = len( infos['raw']['points'] ) / 3
+
+        for t in xrange(targets):
+            _r = numpy.random.RandomState(t)
+            moved = _r.random_sample(nv)
+            ids = numpy.flatnonzero( moved < ratio*1.1 )
+            deltas = _r.standard_normal( (len(ids), 3) ) * 0.1
+            deltas[ moved[ids] >= ratio ] *= 1e-4
+            yield '%s_target%d' % (shp.parent, t), ids, deltas
+
+
+    def parents(self, node):
+        parents = []
+        while node.parent is not None:
+            node = node.parent
+            parents.append(node)
+        return parents
+
+
+    def worldMatrix(self, node, time=None):
+
+        if time is None:
+            time = 0
+
+        key = (node, time)
+        if key not in self._matrices:
+            a = node.amplitude * math.sin( time*0.1 + node.phase )
+            c, s = math.cos(a), math.sin(a)
+            m = [ [1.0,0,0,0], [0,1.0,0,0], [0,0,1.0,0], list(node.offset)+[1.0] ]
+            i, j = [ (1,2), (2,0), (0,1) ][node.axis]
+            m[i][i], m[i][j], m[j][i], m[j][j] = c, s, -s, c
+
+            if node.parent is not None:
+                m = threeMaya.matrixMult( m, self.worldMatrix(node.parent, time) )
+            self._matrices[key] = m
+
+        return self._matrices[key]
+
+
+    def worldMatrices(self, nodes, times):
+        m = [ [ self.worldMatrix(node, t) for node in nodes ] for t in times ]
+        return numpy.array(m, numpy.float64).reshape(len(times), len(nodes), 4, 4)
+
+
+    def keyTimes(self, nodes):
+        if not self.bones:
+            return []
+        return range(self.frames+1)
+
+
+    def clips(self):
+        return list(self._clips)
+
+
+    def fps(self):
+        return self._fps
+
+
+    def progressStart(self, title, count):
+        pass
+
+    def progress(self, status=None, step=0):
+        pass
+
+    def progressEnd(self):
+        pass